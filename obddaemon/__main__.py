@@ -8,8 +8,7 @@ from logging import DEBUG
 from carpicommons.log import DEFAULT_CONFIG
 from daemoncommons.daemon import DaemonRunner
 
-from obddaemon.daemon import ObdDaemon
-from obddaemon.custom.daemon import SerialObdDaemon
+from obddaemon.registry import load_daemon, MODE_SERIAL, MODE_OBD
 
 from sys import argv
 
@@ -25,5 +24,10 @@ if __name__ == '__main__':
         DEFAULT_CONFIG['root']['level'] = DEBUG
         # DEFAULT_CONFIG['root']['handlers'] = ['h', 'fi']
 
+    mode = MODE_SERIAL if '--serial' in argv else MODE_OBD
     d = DaemonRunner('OBD_DAEMON_CFG', ['obd.ini', '/etc/carpi/obd.ini'])
-    d.run(SerialObdDaemon() if '--serial' in argv else ObdDaemon())
+    if '--supervisor' in argv:
+        from obddaemon.supervisor import Supervisor
+        d.run(Supervisor(mode))
+    else:
+        d.run(load_daemon(mode)())
@@ -0,0 +1,168 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Rolling min / max / mean per channel over time windows (e.g. the last 1, 10 and 60 seconds).
+Every channel keeps its samples in a fixed-size ring buffer shared by its windows,
+every window keeps a running sum and monotonic queues of its min and max candidates,
+so adding a sample and reading an aggregate take amortized constant time.
+"""
+from array import array
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+from redisdatabus.bus import TypedBusListener
+
+from obddaemon.keys import build_key, key_name
+
+AGGREGATE_MIN = 'min'
+AGGREGATE_MAX = 'max'
+AGGREGATE_MEAN = 'mean'
+
+
+def aggregate_key(channel: str, aggregate: str, window: float) -> str:
+    """
+    Returns the channel of an aggregate, e.g. "f#carpi.obd.rpm.mean_10s"
+    """
+    return build_key(TypedBusListener.TYPE_PREFIX_FLOAT,
+                     "{}.{}_{:g}s".format(key_name(channel), aggregate, window))
+
+
+class RingBuffer(object):
+    """
+    The last samples of a channel, sample n (counted from 0) is stored at n % capacity
+    """
+    __slots__ = ['capacity', 'times', 'values', 'count']
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.count = 0
+
+    def append(self, t: float, v: float) -> int:
+        """
+        :return: Number of the sample
+        """
+        n = self.count
+        i = n % self.capacity
+        self.times[i] = t
+        self.values[i] = v
+        self.count = n + 1
+        return n
+
+
+class RollingWindow(object):
+    """
+    Aggregates the samples of a ring buffer taken within the last `length` seconds
+    """
+    __slots__ = ['length', '_ring', '_first', '_sum', '_min', '_max']
+
+    def __init__(self, ring: RingBuffer, length: float):
+        self.length = length
+        self._ring = ring
+        self._first = 0       # number of the oldest sample within the window
+        self._sum = 0.0
+        self._min = deque()   # (sample number, value), values ascending
+        self._max = deque()   # (sample number, value), values descending
+
+    def add(self, n: int, v: float):
+        self._sum += v
+        q = self._min
+        while q and q[-1][1] >= v:
+            q.pop()
+        q.append((n, v))
+        q = self._max
+        while q and q[-1][1] <= v:
+            q.pop()
+        q.append((n, v))
+
+    def expire(self, now: float, keep: int):
+        """
+        Drops the samples older than the window
+        :param now: Current time
+        :param keep: Max. number of samples to keep
+        """
+        ring = self._ring
+        first, end = self._first, ring.count
+        oldest = now - self.length
+        capacity = ring.capacity
+        while first < end and (end - first > keep or ring.times[first % capacity] < oldest):
+            self._sum -= ring.values[first % capacity]
+            if self._min[0][0] == first:
+                self._min.popleft()
+            if self._max[0][0] == first:
+                self._max.popleft()
+            first += 1
+        if first == end:
+            # no rounding errors carried over once the window is empty
+            self._sum = 0.0
+        self._first = first
+
+    def aggregates(self) -> dict:
+        """
+        :return: Aggregate -> value, None if the window is empty
+        """
+        n = self._ring.count - self._first
+        if not n:
+            return None
+        return {
+            AGGREGATE_MIN: self._min[0][1],
+            AGGREGATE_MAX: self._max[0][1],
+            AGGREGATE_MEAN: self._sum / n
+        }
+
+
+class RollingAggregates(object):
+    """
+    Rolling windows of all channels, samples are added from the publishing
+    thread and the aggregates may be read from another one
+    """
+
+    def __init__(self, channels: list, windows: list, capacity: int = 2048):
+        """
+        :param channels: Channels to aggregate
+        :param windows: Window lengths in [sec]
+        :param capacity: Max. number of samples per channel, limits the longest window at high poll rates
+        """
+        self._lock = Lock()
+        self._capacity = capacity
+        self._windows = {}
+        for channel in channels:
+            ring = RingBuffer(capacity)
+            self._windows[channel] = (ring, [RollingWindow(ring, length) for length in windows])
+
+    def add(self, channel: str, value, now: float = None):
+        entry = self._windows.get(channel)
+        if entry is None or not isinstance(value, (int, float)):
+            return
+        if now is None:
+            now = monotonic()
+
+        ring, windows = entry
+        with self._lock:
+            # the oldest sample is dropped before it gets overwritten
+            for w in windows:
+                w.expire(now, ring.capacity - 1)
+            n = ring.append(now, value)
+            for w in windows:
+                w.add(n, value)
+
+    def collect(self, now: float = None) -> list:
+        """
+        :return: List of (channel, value) of all aggregates of non-empty windows
+        """
+        if now is None:
+            now = monotonic()
+        results = []
+        with self._lock:
+            for channel, (ring, windows) in self._windows.items():
+                for w in windows:
+                    w.expire(now, ring.capacity)
+                    aggregates = w.aggregates()
+                    if aggregates:
+                        for aggregate, v in aggregates.items():
+                            results.append((aggregate_key(channel, aggregate, w.length), v))
+        return results
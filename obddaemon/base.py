@@ -0,0 +1,300 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+"""
+import json
+from logging import Logger
+from os import replace
+from time import monotonic
+from typing import Any
+
+from daemoncommons.daemon import Daemon
+from redis import StrictRedis
+from redisdatabus.bus import BusWriter
+
+from obddaemon.aggregates import RollingAggregates
+from obddaemon.bus import FrameBusWriter, StreamBusWriter, store, connection_pool
+from obddaemon.derived import DerivedMetrics, VehicleParameters, build_derivations
+from obddaemon.filter import PublishFilter, parse_deadband
+from obddaemon.keys import key_name, PUBLISHED_KEYS, KEY_BASE, KEY_METRICS, KEY_STREAM
+from obddaemon.metrics import Metrics, STAGE_PUBLISH, STAGE_FLUSH, STAGE_STARTUP
+from obddaemon.scheduler import PollScheduler
+from obddaemon.snapshot import SnapshotWriter
+
+
+class ObdBaseDaemon(Daemon):
+    """
+    Functionality shared by all OBD daemons
+    """
+    DEFAULT_POLL_RATE = 2.0
+
+    def __init__(self, daemon_name: str):
+        super().__init__(daemon_name)
+        self._log: Logger = None
+        self._bus: BusWriter = None
+        self._filter: PublishFilter = None
+        self._scheduler: PollScheduler = None
+        self._metrics: Metrics = None
+        self._derived: DerivedMetrics = None
+        self._aggregates: RollingAggregates = None
+        self._snapshot: SnapshotWriter = None
+        self._publish_counter = None
+        self._started: float = None
+        self._last_rate_report = 0
+        self._last_filter_report = 0
+        self._last_metrics_report = 0
+        self._last_aggregates_publish = 0
+
+    def set_publish_counter(self, counter):
+        """
+        Sets a shared counter (multiprocessing.Value) incremented for every published value
+        """
+        self._publish_counter = counter
+
+    def _setup_bus(self) -> BusWriter:
+        """
+        Sets up the bus writer and everything values pass on their way to it
+        """
+        self._started = monotonic()
+        self._bus = self._build_bus_writer()
+        self._filter = self._build_publish_filter()
+        self._derived = self._build_derived_metrics()
+        self._aggregates = self._build_aggregates()
+        self._snapshot = self._build_snapshot()
+        if self._get_config_bool('Metrics', 'Enabled', True):
+            self._metrics = Metrics()
+            self._last_metrics_report = monotonic()
+        return self._bus
+
+    def _build_bus_writer(self, redis: StrictRedis = None) -> BusWriter:
+        """
+        :param redis: Redis instance to use instead of connecting to the configured one
+        """
+        self._log.info("Connecting to Redis instance ...")
+        if redis is None:
+            redis = StrictRedis(connection_pool=connection_pool(
+                host=self._get_config('Redis', 'Host', '127.0.0.1'),
+                port=self._get_config_int('Redis', 'Port', 6379),
+                db=self._get_config_int('Redis', 'DB', 0),
+                password=self._get_config('Redis', 'Password', None)))
+        params = dict(redis=redis)
+
+        if self._get_config_bool('Stream', 'Enabled', False):
+            stream = self._get_config('Stream', 'Key', KEY_STREAM)
+            self._log.info("Appending frames to stream %s", stream)
+            return StreamBusWriter(stream=stream,
+                                   max_len=self._get_config_int('Stream', 'MaxLen', 10000),
+                                   retention=self._get_config_float('Stream', 'Retention', 0),
+                                   trim_interval=self._get_config_float('Stream', 'TrimInterval', 10),
+                                   max_size=self._get_config_int('Redis', 'PipelineMaxSize', 32),
+                                   max_delay=self._get_config_float('Redis', 'PipelineMaxDelay', 0.25),
+                                   **params)
+        elif self._get_config_bool('Redis', 'Pipeline', False):
+            self._log.info("Using pipelined frame publishing")
+            return FrameBusWriter(max_size=self._get_config_int('Redis', 'PipelineMaxSize', 32),
+                                  max_delay=self._get_config_float('Redis', 'PipelineMaxDelay', 0.25),
+                                  **params)
+        else:
+            return BusWriter(**params)
+
+    def _reconnect_delay(self, attempt: int) -> float:
+        """
+        Returns the time in [sec] to wait before the given reconnect attempt (0 = first),
+        starting at [OBD] ReconnectDelay and doubled on every attempt up to [OBD] MaxReconnectDelay
+        """
+        delay = self._get_config_float('OBD', 'ReconnectDelay', 0.5) * 2 ** attempt
+        return min(delay, self._get_config_float('OBD', 'MaxReconnectDelay', 30))
+
+    def _build_publish_filter(self) -> PublishFilter:
+        if not self._get_config_bool('Deadband', 'Enabled', False):
+            return None
+
+        default = self._get_config('Deadband', 'Default', '0')
+        deadbands = {channel: parse_deadband(self._get_config('Deadband', key_name(channel), default))
+                     for channel in PUBLISHED_KEYS}
+        self._log.info("Using deadband publish filter")
+        self._last_filter_report = monotonic()
+        return PublishFilter(deadbands, self._get_config_float('Deadband', 'Heartbeat', 10))
+
+    def _build_derived_metrics(self) -> DerivedMetrics:
+        if not self._get_config_bool('Derived', 'Enabled', False):
+            return None
+
+        params = VehicleParameters(
+            displacement=self._get_config_float('Derived', 'Displacement', 1.6),
+            volumetric_efficiency=self._get_config_float('Derived', 'VolumetricEfficiency', 0.85),
+            air_fuel_ratio=self._get_config_float('Derived', 'AirFuelRatio', 14.7),
+            fuel_density=self._get_config_float('Derived', 'FuelDensity', 745),
+            tire_circumference=self._get_config_float('Derived', 'TireCircumference', 1.95),
+            final_drive=self._get_config_float('Derived', 'FinalDrive', 1.0),
+            min_speed=self._get_config_float('Derived', 'MinSpeed', 5))
+        self._log.info("Publishing derived values")
+        return DerivedMetrics(build_derivations(params),
+                              self._get_config_bool('Derived', 'TripDistance', True))
+
+    def _build_aggregates(self) -> RollingAggregates:
+        if not self._get_config_bool('Aggregates', 'Enabled', False):
+            return None
+
+        windows = [float(w) for w in self._get_config('Aggregates', 'Windows', '1,10,60').split(',') if w.strip()]
+        names = [n.strip() for n in self._get_config('Aggregates', 'Channels', '').split(',') if n.strip()]
+        channels = [c for c in PUBLISHED_KEYS if not names or key_name(c) in names]
+        self._log.info("Publishing min/max/mean of %d channels over %s seconds",
+                       len(channels), ', '.join('{:g}'.format(w) for w in windows))
+        self._last_aggregates_publish = monotonic()
+        return RollingAggregates(channels, windows, self._get_config_int('Aggregates', 'Capacity', 2048))
+
+    def _build_snapshot(self) -> SnapshotWriter:
+        if not self._get_config_bool('Snapshot', 'Enabled', False):
+            return None
+
+        path = self._get_config('Snapshot', 'Path', '/dev/shm/{}snapshot'.format(KEY_BASE))
+        self._log.info("Writing latest values to snapshot %s", path)
+        return SnapshotWriter(path, [key_name(c) for c in PUBLISHED_KEYS])
+
+    def _publish(self, channel: str, value: Any, t: float = None):
+        """
+        Publishes a value along with the values derived from it
+        :param t: Time of the sample in [sec] (e.g. the replay position), defaults to the current time
+        """
+        self._publish_value(channel, value)
+        self._record(channel, value)
+        if self._derived:
+            # derived values are computed from every sample, also from the filtered ones
+            for derived_channel, derived_value in self._derived.update(channel, value, t):
+                self._publish_value(derived_channel, derived_value)
+                self._record(derived_channel, derived_value)
+
+    def _record(self, channel: str, value: Any):
+        """
+        Keeps every sample in the aggregates and the snapshot, also the filtered ones
+        """
+        if self._aggregates:
+            self._aggregates.add(channel, value)
+        if self._snapshot:
+            self._snapshot.write(key_name(channel), value)
+
+    def _publish_value(self, channel: str, value: Any):
+        if self._filter and not self._filter.accept(channel, value):
+            return
+        start = monotonic()
+        self._bus.publish(channel, value)
+        if self._publish_counter is not None:
+            self._publish_counter.value += 1
+        if self._started is not None:
+            self._report_first_publish()
+        if self._metrics:
+            self._metrics.observe(STAGE_PUBLISH, key_name(channel), monotonic() - start)
+
+    def _report_first_publish(self):
+        duration = monotonic() - self._started
+        self._started = None
+        self._log.info("First value published %.2f seconds after startup", duration)
+        if self._metrics:
+            self._metrics.observe(STAGE_STARTUP, 'first_publish', duration)
+
+    def _flush_bus(self):
+        """
+        Sends all values collected by a pipelined bus writer, call this after every polling cycle
+        """
+        if isinstance(self._bus, FrameBusWriter):
+            start = monotonic()
+            self._bus.flush()
+            if self._metrics:
+                self._metrics.observe(STAGE_FLUSH, 'frame', monotonic() - start)
+
+    def _flush_bus_if_due(self):
+        """
+        Sends the values collected by a pipelined bus writer once they are held back for
+        [Redis] PipelineMaxDelay, call this regularly when values are published outside of a polling cycle
+        """
+        if isinstance(self._bus, FrameBusWriter):
+            self._bus.flush_if_due()
+
+    def _flush_check_interval(self) -> float:
+        """
+        Returns the time in [sec] between two calls of _flush_bus_if_due
+        """
+        if isinstance(self._bus, FrameBusWriter):
+            return min(self._bus.max_delay / 2, 1)
+        return 1
+
+    def _build_scheduler(self, items: dict) -> PollScheduler:
+        """
+        Builds a polling scheduler with the rates configured in [PollRates]
+        :param items: Channel key per item to poll
+        """
+        default = self._get_config_float('PollRates', 'Default', ObdBaseDaemon.DEFAULT_POLL_RATE)
+        rates = {item: self._get_config_float('PollRates', key_name(channel), default)
+                 for item, channel in items.items()}
+        for item, rate in rates.items():
+            self._log.debug("Polling %s at %.2f Hz", item, rate)
+
+        self._last_rate_report = monotonic()
+        return PollScheduler(rates, self._get_config_float('PollRates', 'MaxBacklog', 1.0))
+
+    def _housekeeping(self):
+        """
+        Periodic tasks, call this after every polling cycle
+        """
+        self._report_poll_rates()
+        self._report_publish_filter()
+        self._report_metrics()
+        self._publish_aggregates()
+
+    def _publish_aggregates(self):
+        """
+        Publishes the rolling aggregates every [Aggregates] PublishInterval seconds
+        """
+        interval = self._get_config_float('Aggregates', 'PublishInterval', 1)
+        if not self._aggregates or monotonic() - self._last_aggregates_publish < interval:
+            return
+
+        self._last_aggregates_publish = monotonic()
+        for channel, value in self._aggregates.collect():
+            self._publish_value(channel, value)
+        self._flush_bus()
+
+    def _report_poll_rates(self):
+        interval = self._get_config_float('PollRates', 'ReportInterval', 60)
+        if not self._scheduler or interval <= 0 \
+                or monotonic() - self._last_rate_report < interval:
+            return
+
+        self._last_rate_report = monotonic()
+        for item, (achieved, target) in sorted(self._scheduler.report().items()):
+            self._log.info("Poll rate %-12s %6.2f / %6.2f Hz", item, achieved, target)
+
+    def _report_publish_filter(self):
+        interval = self._get_config_float('Deadband', 'ReportInterval', 60)
+        if not self._filter or interval <= 0 \
+                or monotonic() - self._last_filter_report < interval:
+            return
+
+        self._last_filter_report = monotonic()
+        for channel, (passed, suppressed) in sorted(self._filter.counters().items()):
+            self._log.info("Published %-28s %8d, suppressed %8d", channel, passed, suppressed)
+
+    def _report_metrics(self):
+        """
+        Stores the metrics as JSON in Redis ([Metrics] Key) and
+        as plain text in [Metrics] DumpPath if configured
+        """
+        interval = self._get_config_float('Metrics', 'ReportInterval', 10)
+        if not self._metrics or interval <= 0 \
+                or monotonic() - self._last_metrics_report < interval:
+            return
+
+        self._last_metrics_report = monotonic()
+        store(self._bus, self._get_config('Metrics', 'Key', KEY_METRICS), json.dumps(self._metrics.snapshot()))
+
+        path = self._get_config('Metrics', 'DumpPath', '')
+        if path:
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    f.write(self._metrics.dump())
+                    f.write('\n')
+                replace(path + '.tmp', path)
+            except IOError:
+                self._log.warning("Failed to write metrics to %s", path)
@@ -0,0 +1,194 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+"""
+from threading import Lock
+from time import monotonic, time
+from typing import Any
+
+from carpicommons.log import logger
+from redis import ConnectionPool
+from redis.exceptions import ResponseError
+from redisdatabus.bus import BusWriter
+
+_pools = {}
+
+
+class FrameBusWriter(BusWriter):
+    """
+    Bus Writer collecting all values of a frame and sending them to Redis
+    in one pipelined round trip.
+    A frame is flushed when flush() is called, when it contains max_size values
+    or when its first value is older than max_delay seconds.
+    """
+
+    def __init__(self,
+                 max_size: int = 32,
+                 max_delay: float = 0.25,
+                 **kwargs):
+        """
+        :param max_size: Max. number of values in a frame
+        :param max_delay: Max. time in [sec] a value is held back
+        :param kwargs: Passed on to BusWriter
+        """
+        super().__init__(**kwargs)
+        self._max_size = max_size
+        self._max_delay = max_delay
+        self._frame = []
+        self._frame_start = 0
+        self._lock = Lock()
+
+    def publish(self, channel: str, value: Any):
+        """
+        Adds a new value to the current frame
+        :param channel: Defines the name of the value
+        :param value: Defines the value itself
+        """
+        with self._lock:
+            if not self._frame:
+                self._frame_start = monotonic()
+            self._frame.append((channel, str(value)))
+            full = len(self._frame) >= self._max_size \
+                or monotonic() - self._frame_start >= self._max_delay
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends all values of the current frame
+        """
+        with self._lock:
+            frame, self._frame = self._frame, []
+
+        if not frame:
+            return
+
+        pipe = self._r.pipeline(transaction=False)
+        self._send_frame(pipe, frame)
+        pipe.execute()
+
+    def _send_frame(self, pipe, frame: list):
+        """
+        Adds the commands sending a frame to the given pipeline
+        :param frame: List of (channel, value)
+        """
+        for channel, value in frame:
+            pipe.publish(channel, value)
+
+    @property
+    def max_delay(self) -> float:
+        return self._max_delay
+
+    def flush_if_due(self):
+        """
+        Sends the current frame if its first value is older than max_delay seconds
+        """
+        if self._frame and monotonic() - self._frame_start >= self._max_delay:
+            self.flush()
+
+
+class StreamBusWriter(FrameBusWriter):
+    """
+    Frame Bus Writer also appending every frame as one entry to a Redis Stream,
+    with the channels as fields, in the same round trip as the published values.
+    The stream is trimmed to about max_len entries and optionally to the entries of the
+    last retention seconds, so consumers can replay the recent history at their own pace.
+    """
+
+    def __init__(self,
+                 stream: str,
+                 max_len: int = 10000,
+                 retention: float = 0,
+                 trim_interval: float = 10,
+                 **kwargs):
+        """
+        :param stream: Key of the stream
+        :param max_len: Approx. max. number of entries, <= 0 for no limit
+        :param retention: Time in [sec] entries are kept, <= 0 to keep them until max_len is reached
+        :param trim_interval: Time in [sec] between trimming the stream to the retention time
+        :param kwargs: Passed on to FrameBusWriter
+        """
+        super().__init__(**kwargs)
+        self._stream = stream
+        self._max_len = max_len if max_len > 0 else None
+        self._retention = retention
+        self._trim_interval = trim_interval
+        self._last_trim = 0
+
+    def _send_frame(self, pipe, frame: list):
+        super()._send_frame(pipe, frame)
+        # a channel sent twice within a frame keeps its last value
+        pipe.xadd(self._stream, dict(frame), maxlen=self._max_len, approximate=True)
+
+    def flush(self):
+        super().flush()
+        if self._retention > 0 and monotonic() - self._last_trim >= self._trim_interval:
+            self._trim()
+
+    def _trim(self):
+        self._last_trim = monotonic()
+        try:
+            # entry IDs start with the time in [ms], XTRIM MINID requires Redis 6.2,
+            # sent on its own so an older server does not fail the published values
+            self._r.execute_command('XTRIM', self._stream, 'MINID', '~', stream_id(time() - self._retention))
+        except ResponseError as e:
+            # looked up here, loggers created on import are disabled once logging is configured
+            logger('OBD Bus').warning("Redis does not support trimming %s by time (%s), only MaxLen applies", self._stream, e)
+            self._retention = 0
+
+
+def stream_id(t: float) -> str:
+    """
+    Returns the first stream entry ID of the given time (sec since the epoch)
+    """
+    return '{}-0'.format(int(t * 1000))
+
+
+def _str(v) -> str:
+    return v.decode('utf-8') if isinstance(v, bytes) else v
+
+
+def replay(redis, stream: str, since: float, batch_size: int = 500):
+    """
+    Reads the entries of a stream written by StreamBusWriter
+    :param redis: Redis instance
+    :param stream: Key of the stream
+    :param since: Time (sec since the epoch) of the first entry to read
+    :param batch_size: Entries read per round trip
+    :return: Generator of (entry ID, time in [sec] since the epoch, {channel: value})
+    """
+    start = stream_id(since)
+    while True:
+        entries = redis.xrange(stream, min=start, max='+', count=batch_size)
+        for entry_id, fields in entries:
+            entry_id = _str(entry_id)
+            yield entry_id, int(entry_id.split('-')[0]) / 1000, {_str(k): _str(v) for k, v in fields.items()}
+        if len(entries) < batch_size:
+            return
+        # continues after the last entry, exclusive ranges would require Redis 6.2
+        ms, seq = entry_id.split('-')
+        start = '{}-{}'.format(ms, int(seq) + 1)
+
+
+def connection_pool(host: str = '127.0.0.1',
+                    port: int = 6379,
+                    db: int = 0,
+                    password: str = None) -> ConnectionPool:
+    """
+    Returns the connection pool of this process for the given Redis instance,
+    all Redis clients of a process share one pool per instance
+    """
+    key = (host, port, db, password)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools[key] = ConnectionPool(host=host, port=port, db=db, password=password)
+    return pool
+
+
+def store(bus: BusWriter, key: str, value: str):
+    """
+    Stores a value under a plain Redis key, using the connection of the given Bus Writer
+    """
+    bus._r.set(key, value)
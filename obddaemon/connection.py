@@ -0,0 +1,122 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+python-obd connections set up from a cached port, baudrate, protocol and
+set of supported commands, skipping the port scan, the baudrate and protocol
+detection and the supported PIDs queries.
+"""
+import json
+from os import makedirs, replace
+from os.path import dirname, exists
+from time import time
+
+from carpicommons.log import logger
+from obd import OBD, Async, OBDStatus, commands
+
+log = logger('OBD Connection Cache')
+
+
+class ConnectionCache(object):
+    """
+    Stores the last working connection in a JSON file
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._data = {}
+        if path and exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._data = json.load(f)
+            except (IOError, ValueError):
+                log.warning("Failed to read connection cache %s, ignoring it", path)
+
+    @property
+    def connection(self) -> tuple:
+        """
+        Port, baudrate and protocol of the last working connection, None if unknown
+        """
+        if not self._data.get('port'):
+            return None
+        return self._data['port'], self._data.get('baudrate'), self._data.get('protocol')
+
+    @property
+    def commands(self) -> set:
+        """
+        Names of the commands supported by the vehicle, None if unknown
+        """
+        names = self._data.get('commands')
+        return set(names) if names is not None else None
+
+    def put(self, connection: tuple, supported: set):
+        """
+        :param connection: Port, baudrate and protocol
+        :param supported: Names of the supported commands
+        """
+        data = {
+            'port': connection[0],
+            'baudrate': connection[1],
+            'protocol': connection[2],
+            'commands': sorted(supported)
+        }
+        if all(self._data.get(k) == v for k, v in data.items()):
+            return
+
+        data['updated'] = time()
+        self._data = data
+        if not self._path:
+            return
+
+        try:
+            if dirname(self._path):
+                makedirs(dirname(self._path), exist_ok=True)
+            tmp = self._path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._data, f, indent=2, sort_keys=True)
+            replace(tmp, self._path)
+        except IOError:
+            log.warning("Failed to write connection cache %s", self._path)
+
+    def clear(self):
+        self._data = {}
+
+
+class CachedCommandsMixin(object):
+    """
+    Takes the supported commands from the given names instead of querying the vehicle,
+    to be mixed into OBD or Async
+    """
+
+    def __init__(self, *args, supported: set = None, **kwargs):
+        """
+        :param supported: Names of the supported commands, None to query them
+        """
+        self._supported_names = supported
+        super().__init__(*args, **kwargs)
+
+    def _OBD__load_commands(self):
+        # replaces OBD.__load_commands, called from OBD.__init__
+        names = self._supported_names
+        if names is None or self.status() != OBDStatus.CAR_CONNECTED:
+            super()._OBD__load_commands()
+            return
+
+        self.supported_commands.update([commands[n] for n in names if commands.has_name(n)])
+        log.info("Loaded %d supported commands from cache", len(self.supported_commands))
+
+
+class CachedOBD(CachedCommandsMixin, OBD):
+    pass
+
+
+class CachedAsync(CachedCommandsMixin, Async):
+    pass
+
+
+def supported_names(obd_inst: OBD) -> set:
+    """
+    Returns the names of the commands supported by a connection
+    """
+    return {c.name for c in obd_inst.supported_commands}
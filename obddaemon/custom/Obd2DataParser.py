@@ -36,15 +36,29 @@ log = logger('OBD DataParser')
 
 UNABLE_TO_CONNECT = 'UNABLE TO CONNECT'
 
+MODE_01_REQUEST = '01'
+MODE_01_RESPONSE = '41'
+
+MAX_PIDS_PER_REQUEST = 6
+
+_HEX_CHARS = '0123456789abcdefABCDEF'
+
 
 class ObdPidParserUnknownError(Exception):
+    _reported = set()
+
     def __init__(self, type, val=None):
         """
         :param str type: OBD PID
         :param str val: (optional) value received to parse
         """
-        log.warning("Failed to parse OBD message %s, value was %s",
-                    type, val)
+        if type in ObdPidParserUnknownError._reported:
+            log.debug("Failed to parse OBD message %s, value was %s",
+                      type, val)
+        else:
+            ObdPidParserUnknownError._reported.add(type)
+            log.warning("Failed to parse OBD message %s, value was %s (reported only once)",
+                        type, val)
         self.type = type
         self.val = val
 
@@ -55,11 +69,12 @@ def is_unable_to_connect(v: str):
 
 def trim_obd_value(v):
     """
-    Trims unneeded data from an OBD response
+    Trims unneeded data (mode and PID) from an OBD response,
+    responses not starting with them (e.g. "NO DATA") are trimmed completely
     :param str v:
     :return str:
     """
-    if not v or len(v) < 4:
+    if not v or len(v) < 4 or v[:4].strip(_HEX_CHARS):
         return ''
     else:
         return v[4:]
@@ -90,10 +105,11 @@ def parse_value(type: str, val: str):
     :param val:
     :return:
     """
-    if type.upper() in PARSER_MAP:
+    parser = PARSER_MAP.get(type.upper())
+    if parser:
         #prep_val = prepare_value(val)
-        out = PARSER_MAP[type](val)
-        log.debug('For {} entered {}, got {} out'.format(type, val, out))
+        out = parser(val)
+        log.debug('For %s entered %s, got %s out', type, val, out)
         return out
     else:
         raise ObdPidParserUnknownError(type, val)
@@ -110,6 +126,7 @@ def parse_obj(o):
     for k, v in o.items():
         if is_unable_to_connect(v):
             r[k] = None
+            continue
 
         try:
             r[k] = parse_value(k, v)
@@ -118,6 +135,88 @@ def parse_obj(o):
     return r
 
 
+def is_mode_01(cmd):
+    """
+    Returns True if the given command is a Mode 01 PID request (e.g. "010C")
+    :param str cmd:
+    :return bool:
+    """
+    return len(cmd) == 4 and cmd.startswith(MODE_01_REQUEST)
+
+
+def build_multi_pid_request(cmds):
+    """
+    Builds a single Mode 01 request asking for several PIDs at once
+    :param list cmds: e.g. ["010B", "010C", "010D"]
+    :return str: e.g. "010B0C0D"
+    """
+    return MODE_01_REQUEST + ''.join([c[2:] for c in cmds])
+
+
+def _join_response_lines(v):
+    """
+    Joins a (possibly multi-frame) response into one hex string.
+    CAN responses longer than one frame are returned by the ELM327 as a
+    byte count line followed by numbered lines, e.g. "00A\n0:410B270C1054\n1:0D00"
+    :param str v:
+    :return str:
+    """
+    length = None
+    data = ''
+    for line in v.split('\n'):
+        line = line.strip()
+        if not line or line.endswith('...'):
+            continue
+        if len(line) == 3 and length is None and not data:
+            try:
+                length = int(line, 16)
+                continue
+            except ValueError:
+                pass
+        if len(line) > 2 and line[1] == ':':
+            line = line[2:]
+        data += line
+    return data[:length * 2] if length else data
+
+
+def split_multi_pid_response(v):
+    """
+    Splits the response to a multi PID request into single PID responses.
+    PIDs not answered by the ECU are not contained in the result.
+    :param str v: e.g. "410B270C10540D00"
+    :return dict: e.g. {"010B": "410B27", "010C": "410C1054", "010D": "410D00"}
+    """
+    r = {}
+    if not v or is_unable_to_connect(v):
+        return r
+
+    data = _join_response_lines(v)
+    if not data.startswith(MODE_01_RESPONSE):
+        return r
+
+    i = len(MODE_01_RESPONSE)
+    while i + 2 <= len(data):
+        pid = data[i:i + 2]
+        size = PID_DATA_BYTES.get(pid)
+        if size is None or i + 2 + size * 2 > len(data):
+            break
+        r[MODE_01_REQUEST + pid] = MODE_01_RESPONSE + data[i:i + 2 + size * 2]
+        i += 2 + size * 2
+    return r
+
+
+def parse_multi_pid(cmds, v):
+    """
+    Parses the response to a multi PID request and returns the parsed value
+    for each of the requested PIDs (None if the PID was not part of the response)
+    :param list cmds: e.g. ["010B", "010C", "010D"]
+    :param str v: e.g. "410B270C10540D00"
+    :return dict:
+    """
+    r = parse_obj(split_multi_pid_response(v))
+    return {c: r.get(c) for c in cmds}
+
+
 # def transform_obj(o):
 #     r = {}
 #     for k, v in o.items():
@@ -144,19 +243,20 @@ def parse_atrv(v):
 
 def parse_0101(v):
     """
-    Parses the DTC status and returns two elements.
+    Parses the DTC status and returns two elements:
+    the MIL status (bit 7 of byte A) and the number of DTCs (bits 0 - 6 of byte A).
     https://en.wikipedia.org/wiki/OBD-II_PIDs#Mode_1_PID_01
-    :param v:
-    :return bool, int:
+    :param v: e.g. "410183076504"
+    :return bool, int: e.g. True, 3
     """
     tv = trim_obd_value(v)
     mil_status = None  # type: bool
     num_dtc = None  # type: int
 
     try:
-        byte_a = int(v[:2], 16)
-        mil_status = byte_a / 0xF >= 1
-        num_dtc = mil_status % 0xF
+        byte_a = int(tv[:2], 16)
+        mil_status = byte_a & 0x80 != 0
+        num_dtc = byte_a & 0x7F
     except ValueError:
         mil_status = None
         num_dtc = None
@@ -188,12 +288,12 @@ def parse_0103(v):
     tv = trim_obd_value(v)  # trimmed value
     status_1, status_2 = None, None
     try:
-        status_1 = int(v[:2], 16)
+        status_1 = int(tv[:2], 16)
     except ValueError:
         status_1 = None
 
     try:
-        status_2 = int(v[2:4], 16)
+        status_2 = int(tv[2:4], 16)
     except ValueError:
         status_2 = None
 
@@ -266,16 +366,16 @@ def parse_010f(v):
 def parse_0134_013b(v):
     """
     Parses the O2 Sensor Value (0134 - 013B) and returns two values parsed from it:
-    1. Fuel-Air Equivalence [Ratio] as a float from 0 - 2
-    2. Current in [mA] as a float from -128 - 128
-    :param str v:
-    :return tuple of float, float:
+    1. Fuel-Air Equivalence [Ratio] as a float from 0 - 2 (bytes A and B)
+    2. Current in [mA] as a float from -128 - 128 (bytes C and D)
+    :param str v: e.g. "413480008080"
+    :return tuple of float, float: e.g. 1.0, 0.5
     """
     try:
         trim_val = trim_obd_value(v)
-        val_ab = int(trim_val[0:2], 16)
-        val_cd = int(trim_val[2:4], 16)
-        return (2 / 65536) * val_ab, val_cd - 128
+        val_ab = int(trim_val[0:4], 16)
+        val_cd = int(trim_val[4:8], 16)
+        return (2 / 65536) * val_ab, val_cd / 256 - 128
     except ValueError:
         return None, None
 
@@ -300,6 +400,282 @@ PARSER_MAP = {
     '013B': parse_0134_013b
 }
 
+# Number of data bytes returned per Mode 01 PID, required to split multi PID responses
+PID_DATA_BYTES = {
+    '01': 4,
+    '03': 2,
+    '04': 1,
+    '05': 1,
+    '0B': 1,
+    '0C': 2,
+    '0D': 1,
+    '0F': 1,
+    '34': 4,
+    '35': 4,
+    '36': 4,
+    '37': 4,
+    '38': 4,
+    '39': 4,
+    '3A': 4,
+    '3B': 4
+}
+
+# data bytes of a CAN single frame, of the first frame and of a consecutive frame of a multi-frame message
+CAN_SINGLE_FRAME_BYTES = 7
+CAN_FIRST_FRAME_BYTES = 6
+CAN_CONSECUTIVE_FRAME_BYTES = 7
+
+
+def response_frames(request, can):
+    """
+    Returns the number of frames an ECU answers a Mode 01 request with
+    :param str request: Single or multi PID request, e.g. "010B0C0D"
+    :param bool can: Whether a CAN protocol is in use, other protocols answer with one frame
+    :return int: Number of frames or None if the size of a PID is unknown
+    """
+    pids = [request[i:i + 2] for i in range(2, len(request), 2)]
+    # "41" followed by every PID and its data
+    size = 1
+    for pid in pids:
+        data = 4 if int(pid, 16) % 0x20 == 0 else PID_DATA_BYTES.get(pid)
+        if data is None:
+            return None
+        size += 1 + data
+    if not can or size <= CAN_SINGLE_FRAME_BYTES:
+        return 1
+    return 1 + -(-(size - CAN_FIRST_FRAME_BYTES) // CAN_CONSECUTIVE_FRAME_BYTES)
+
+# Bytes based decoding
+# The functions below decode responses straight from the bytes received by
+# the serial port (bytes, bytearray or memoryview) without creating
+# intermediate strings. Every decoder gets the buffer and the range of the
+# payload within it, for Mode 01 PIDs this is the data after "41XX".
+
+_HEX_DIGITS = tuple(int(chr(c), 16) if chr(c) in '0123456789abcdefABCDEF' else -1
+                    for c in range(256))
+_WHITESPACE = b' \r\n\t>'
+_UNABLE_TO_CONNECT_BYTES = UNABLE_TO_CONNECT.encode()
+_MULTI_FRAME_MARK = ord(':')
+_CR = ord('\r')
+
+
+def _strip_bytes(buf, start, end):
+    while start < end and buf[start] in _WHITESPACE:
+        start += 1
+    while end > start and buf[end - 1] in _WHITESPACE:
+        end -= 1
+    return start, end
+
+
+def _hex_int(buf, start, end) -> int:
+    """
+    Decodes the hex digits buf[start:end] into an integer
+    :raises ValueError: if the range is empty or contains a non hex digit
+    """
+    if start >= end:
+        raise ValueError
+    val = 0
+    for i in range(start, end):
+        d = _HEX_DIGITS[buf[i]]
+        if d < 0:
+            raise ValueError
+        val = (val << 4) | d
+    return val
+
+
+def _is_hex(buf, start, end) -> bool:
+    if end > len(buf):
+        return False
+    for i in range(start, end):
+        if _HEX_DIGITS[buf[i]] < 0:
+            return False
+    return True
+
+
+def _decode_atrv(buf, start, end):
+    if end > start and buf[end - 1] == ord('V'):
+        end -= 1
+    try:
+        return float(bytes(buf[start:end]))
+    except ValueError:
+        return None
+
+
+def _decode_int(buf, start, end):
+    try:
+        return _hex_int(buf, start, end)
+    except ValueError:
+        return None
+
+
+def _decode_0101(buf, start, end):
+    try:
+        byte_a = _hex_int(buf, start, min(start + 2, end))
+        return byte_a & 0x80 != 0, byte_a & 0x7F
+    except ValueError:
+        return None, None
+
+
+def _decode_0103(buf, start, end):
+    status_1, status_2 = None, None
+    try:
+        status_1 = _hex_int(buf, start, min(start + 2, end))
+    except ValueError:
+        status_1 = None
+
+    try:
+        status_2 = _hex_int(buf, start + 2, min(start + 4, end))
+    except ValueError:
+        status_2 = None
+
+    return status_1, status_2
+
+
+def _decode_0104(buf, start, end):
+    try:
+        return _hex_int(buf, start, end) / 2.55
+    except ValueError:
+        return None
+
+
+def _decode_010c(buf, start, end):
+    try:
+        return int(_hex_int(buf, start, end) / 4)
+    except ValueError:
+        return None
+
+
+def _decode_010f(buf, start, end):
+    try:
+        return _hex_int(buf, start, end) - 40
+    except ValueError:
+        return None
+
+
+def _decode_0134_013b(buf, start, end):
+    try:
+        val_ab = _hex_int(buf, start, min(start + 4, end))
+        val_cd = _hex_int(buf, start + 4, min(start + 8, end))
+        return (2 / 65536) * val_ab, val_cd / 256 - 128
+    except ValueError:
+        return None, None
+
+
+def parse_response(cmd: str, buf):
+    """
+    Parses the raw response to a single command as returned by the serial port.
+    Commands without a bytes decoder fall back to the string based PARSER_MAP.
+    :param str cmd: e.g. "010C"
+    :param buf: bytes-like response, e.g. b"410C1054\r"
+    :return: Parsed value or None
+    """
+    if buf is None:
+        return None
+
+    start, end = _strip_bytes(buf, 0, len(buf))
+    if end - start >= len(_UNABLE_TO_CONNECT_BYTES) \
+            and buf[end - len(_UNABLE_TO_CONNECT_BYTES):end] == _UNABLE_TO_CONNECT_BYTES:
+        return None
+
+    decoder = BYTES_PARSER_MAP.get(cmd)
+    if decoder is None:
+        return parse_obj({cmd: bytes(buf[start:end]).decode('utf-8', 'replace')})[cmd]
+    elif is_mode_01(cmd):
+        # error messages like "NO DATA" do not start with mode and PID
+        start = start + 4 if _is_hex(buf, start, start + 4) else end
+    return decoder(buf, start, end)
+
+
+def _frame_data(buf):
+    """
+    Returns the buffer and range holding the payload of a (possibly multi-frame) response.
+    Multi-frame responses are joined into a new buffer.
+    """
+    start, end = _strip_bytes(buf, 0, len(buf))
+    if _MULTI_FRAME_MARK not in buf[start:end]:
+        return buf, start, end
+
+    data = bytearray()
+    length = None
+    for line in bytes(buf[start:end]).split(b'\r'):
+        line = line.strip()
+        if not line or line.endswith(b'...'):
+            continue
+        if len(line) == 3 and length is None and not data:
+            try:
+                length = _hex_int(line, 0, 3)
+                continue
+            except ValueError:
+                pass
+        if len(line) > 2 and line[1] == _MULTI_FRAME_MARK:
+            line = line[2:]
+        data += line
+    if length:
+        del data[length * 2:]
+    return data, 0, len(data)
+
+
+def parse_multi_pid_response(cmds: list, buf) -> dict:
+    """
+    Parses the raw response to a multi PID request and returns the parsed value
+    for each of the requested PIDs (None if the PID was not part of the response).
+    Equivalent to parse_multi_pid for responses from the serial port.
+    :param list cmds: e.g. ["010B", "010C", "010D"]
+    :param buf: bytes-like response, e.g. b"410B270C10540D00\r"
+    :return dict:
+    """
+    r = dict.fromkeys(cmds)
+    if buf is None:
+        return r
+
+    buf, i, end = _frame_data(buf)
+    if end - i < 2 or _hex_int_or_none(buf, i, i + 2) != 0x41:
+        return r
+
+    i += 2
+    while i + 2 <= end:
+        pid = _hex_int_or_none(buf, i, i + 2)
+        cmd = PID_COMMANDS.get(pid)
+        size = PID_DATA_BYTES.get(cmd[2:]) if cmd else None
+        if size is None or i + 2 + size * 2 > end:
+            break
+        decoder = BYTES_PARSER_MAP.get(cmd)
+        if cmd in r and decoder:
+            r[cmd] = decoder(buf, i + 2, i + 2 + size * 2)
+        i += 2 + size * 2
+    return r
+
+
+def _hex_int_or_none(buf, start, end):
+    try:
+        return _hex_int(buf, start, end)
+    except ValueError:
+        return None
+
+
+BYTES_PARSER_MAP = {
+    'ATRV': _decode_atrv,
+    '0101': _decode_0101,
+    '0103': _decode_0103,
+    '0104': _decode_0104,
+    '0105': _decode_010f,
+    '010B': _decode_int,
+    '010C': _decode_010c,
+    '010D': _decode_int,
+    '010F': _decode_010f,
+    '0134': _decode_0134_013b,
+    '0135': _decode_0134_013b,
+    '0136': _decode_0134_013b,
+    '0137': _decode_0134_013b,
+    '0138': _decode_0134_013b,
+    '0139': _decode_0134_013b,
+    '013A': _decode_0134_013b,
+    '013B': _decode_0134_013b
+}
+
+# Mode 01 command per PID number, used to look up PIDs in multi PID responses
+PID_COMMANDS = {int(pid, 16): MODE_01_REQUEST + pid for pid in PID_DATA_BYTES}
+
 OBD_REDIS_MAP = {
     'ATRV': None,
     '0101': None,
@@ -0,0 +1,163 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Vectorized decoding of recorded ELM327 responses, requires numpy
+(pip install carpi-obddaemon[batch]).
+"""
+import numpy as np
+
+from obddaemon.custom.Obd2DataParser import PARSER_MAP, ObdPidParserUnknownError, \
+    parse_atrv, parse_0101, parse_0103, parse_0104, parse_010b, parse_010c, parse_010d, \
+    parse_010f, parse_0134_013b
+
+CHUNK_SIZE = 65536
+
+# Values above 13 hex digits can not be represented exactly as float64
+_MAX_HEX_DIGITS = 13
+
+_HEX_LUT = np.full(128, -1, dtype=np.int8)
+_HEX_LUT[ord('0'):ord('9') + 1] = np.arange(10)
+_HEX_LUT[ord('A'):ord('F') + 1] = np.arange(10, 16)
+_HEX_LUT[ord('a'):ord('f') + 1] = np.arange(10, 16)
+
+
+def parse_batch(type: str, values) -> np.ndarray:
+    """
+    Parses an array of raw responses of one OBD PID and returns the parsed values
+    as float array, NaN marking values which could not be parsed.
+    Results are identical to the functions in PARSER_MAP, PIDs returning two values
+    (e.g. 0103, 0134 - 013B) result in an array of shape (n, 2).
+    :param str type: OBD PID
+    :param values: Sequence of response strings (None is accepted) or numpy str array
+    :return np.ndarray:
+    """
+    parser = PARSER_MAP.get(type.upper())
+    if parser is None:
+        raise ObdPidParserUnknownError(type)
+
+    if not (isinstance(values, np.ndarray) and values.dtype.kind == 'U'):
+        values = list(values)
+    width = 2 if parser in _TWO_VALUE_PARSERS else 1
+    out = np.empty((len(values), width), dtype=np.float64)
+    for i in range(0, len(values), CHUNK_SIZE):
+        chunk = values[i:i + CHUNK_SIZE]
+        out[i:i + len(chunk)] = _parse_chunk(parser, chunk)
+
+    return out if width == 2 else out[:, 0]
+
+
+def _parse_chunk(parser, values) -> np.ndarray:
+    decoder = _DECODERS.get(parser)
+    if decoder is None:
+        return _parse_scalar(parser, values, np.ones(len(values), dtype=bool))
+
+    if isinstance(values, np.ndarray):
+        s = values
+    else:
+        s = np.array(['' if v is None else v for v in values], dtype=np.str_)
+    lengths = np.char.str_len(s) if len(s) else np.zeros(0, dtype=np.int64)
+    if s.dtype.itemsize == 0:
+        codes = np.zeros((len(s), 0), dtype=np.uint32)
+    else:
+        codes = s.view(np.uint32).reshape(len(s), -1)
+
+    digits = _hex_digits(codes)
+    out, valid = decoder(digits, lengths)
+    # responses not starting with mode and PID (e.g. "NO DATA") are left to the scalar parser
+    valid &= _decode_hex(digits, lengths, 0, 4)[1] & (lengths >= 4)
+
+    # rows the vectorized decoder can not handle exactly are parsed one by one
+    invalid = ~valid
+    if invalid.any():
+        out[invalid] = _parse_scalar(parser, values, invalid)[invalid]
+    return out
+
+
+def _parse_scalar(parser, values, rows: np.ndarray) -> np.ndarray:
+    out = np.full((len(values), 2 if parser in _TWO_VALUE_PARSERS else 1), np.nan)
+    for i in np.flatnonzero(rows):
+        try:
+            r = parser(values[i])
+        except (AttributeError, TypeError):
+            r = None
+        if not isinstance(r, tuple):
+            r = (r,)
+        out[i] = [np.nan if x is None else float(x) for x in r]
+    return out
+
+
+def _hex_digits(codes: np.ndarray) -> np.ndarray:
+    """
+    Returns the value of every hex digit, -1 for all other characters
+    """
+    return _HEX_LUT[np.minimum(codes, len(_HEX_LUT) - 1)]
+
+
+def _decode_hex(digits: np.ndarray, lengths: np.ndarray, start: int, stop: int = None):
+    """
+    Decodes the characters [start:stop] of every row as hex number like int(v[start:stop], 16)
+    :return: values, a mask of the rows which have been decoded and a mask of the
+             rows containing other characters than hex digits in the range
+    """
+    end = lengths if stop is None else np.minimum(lengths, stop)
+    last = digits.shape[1] if stop is None else min(stop, digits.shape[1])
+
+    values = np.zeros(len(digits), dtype=np.float64)
+    invalid_char = np.zeros(len(digits), dtype=bool)
+    for col in range(start, last):
+        in_range = col < end
+        d = digits[:, col]
+        invalid_char |= in_range & (d < 0)
+        values = np.where(in_range, values * 16 + d, values)
+
+    valid = (end > start) & (end - start <= _MAX_HEX_DIGITS) & ~invalid_char
+    return values, valid, invalid_char
+
+
+def _decode_trimmed(digits, lengths):
+    values, valid, _ = _decode_hex(digits, lengths, 4)
+    return values, valid & (lengths >= 4)
+
+
+def _int_decoder(transform):
+    def decoder(digits, lengths):
+        values, valid = _decode_trimmed(digits, lengths)
+        return transform(values)[:, None], valid
+    return decoder
+
+
+def _decode_0101(digits, lengths):
+    byte_a, valid, _ = _decode_hex(digits, lengths, 4, 6)
+    mil_status = (byte_a >= 0x80).astype(np.float64)
+    return np.stack([mil_status, byte_a % 0x80], axis=1), valid
+
+
+def _decode_0103(digits, lengths):
+    a, valid_a, invalid_a = _decode_hex(digits, lengths, 4, 6)
+    b, valid_b, invalid_b = _decode_hex(digits, lengths, 6, 8)
+    # both statuses are parsed independently, an empty status is NaN
+    out = np.stack([np.where(valid_a, a, np.nan), np.where(valid_b, b, np.nan)], axis=1)
+    return out, ~(invalid_a | invalid_b)
+
+
+def _decode_0134_013b(digits, lengths):
+    ab, valid_ab, _ = _decode_hex(digits, lengths, 4, 8)
+    cd, valid_cd, _ = _decode_hex(digits, lengths, 8, 12)
+    return np.stack([(2 / 65536) * ab, cd / 256 - 128], axis=1), valid_ab & valid_cd
+
+
+_TWO_VALUE_PARSERS = {parse_0101, parse_0103, parse_0134_013b}
+
+_DECODERS = {
+    parse_atrv: None,  # decimal values, parsed by float() one by one
+    parse_0101: _decode_0101,
+    parse_0103: _decode_0103,
+    parse_0104: _int_decoder(lambda v: v / 2.55),
+    parse_010b: _int_decoder(lambda v: v),
+    parse_010c: _int_decoder(lambda v: np.trunc(v / 4)),
+    parse_010d: _int_decoder(lambda v: v),
+    parse_010f: _int_decoder(lambda v: v - 40),
+    parse_0134_013b: _decode_0134_013b,
+}
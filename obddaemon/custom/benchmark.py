@@ -0,0 +1,227 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+End-to-end benchmark of the serial daemon against the ELM327 emulator:
+python -m obddaemon.custom.benchmark --duration 10 --latency 0.01 --set OBD.FastMode=1
+"""
+import asyncio
+from argparse import ArgumentParser
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from threading import Lock
+from time import monotonic
+
+from carpicommons.errors import CarPiExitException, ExitCodes
+
+from obddaemon.custom.daemon import SerialObdDaemon
+from obddaemon.custom.emulator import Elm327Emulator, ALL_ERRORS
+from obddaemon.custom.transport import Elm327Transport
+from obddaemon.metrics import Metrics
+
+BENCHMARK_CONFIG = {
+    'OBD': {
+        'Baudrate': '38400',
+        'Timeout': '1',
+        'MultiPid': '1',
+        'DiscoverPids': '1',
+        'CapabilityCache': '',
+        'FastMode': '0'
+    },
+    'PollRates': {
+        'Default': '1000',  # poll as fast as possible
+        'ReportInterval': '0'
+    },
+    'Redis': {
+        'Pipeline': '0'
+    }
+}
+
+
+class NullRedis(object):
+    """
+    Stands in for StrictRedis, counts the published messages instead of sending them
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.published = Counter()
+        self.stream_entries = 0
+
+    def publish(self, channel: str, value: str):
+        with self._lock:
+            self.published[channel] += 1
+
+    def set(self, key: str, value: str):
+        pass
+
+    def xadd(self, name: str, fields: dict, **kwargs):
+        with self._lock:
+            self.stream_entries += 1
+
+    def execute_command(self, *args):
+        pass
+
+    def pipeline(self, transaction: bool = True):
+        return _NullPipeline(self)
+
+
+class _NullPipeline(object):
+    def __init__(self, redis: NullRedis):
+        self._redis = redis
+
+    def publish(self, channel: str, value: str):
+        self._redis.publish(channel, value)
+
+    def xadd(self, name: str, fields: dict, **kwargs):
+        self._redis.xadd(name, fields, **kwargs)
+
+    def execute_command(self, *args):
+        self._redis.execute_command(*args)
+
+    def execute(self):
+        return []
+
+
+class BenchmarkDaemon(SerialObdDaemon):
+    """
+    Serial daemon publishing to a NullRedis, stops after the given duration
+    and records the latency of every query
+    """
+
+    def __init__(self, duration: float):
+        super().__init__()
+        self._duration = duration
+        self._redis = NullRedis()
+        self._latencies = defaultdict(list)
+        self._failures = Counter()
+        self._frames = 0
+        self._measuring = False
+        self._elapsed = 0.0
+
+    def _build_bus_writer(self, redis=None):
+        return super()._build_bus_writer(redis=self._redis)
+
+    async def _acquire(self, transport: Elm327Transport, executor: ThreadPoolExecutor):
+        await self._measure(super()._acquire(transport, executor))
+
+    async def _monitor(self, transport: Elm327Transport, protocol: str, executor: ThreadPoolExecutor):
+        await self._measure(super()._monitor(transport, protocol, executor))
+
+    async def _measure(self, acquisition):
+        self._measuring = True
+        start = monotonic()
+        asyncio.get_event_loop().call_later(self._duration, self._stop)
+        await acquisition
+        self._elapsed = monotonic() - start
+        self._measuring = False
+        raise CarPiExitException(ExitCodes.OK)
+
+    def _stop(self):
+        self._running = False
+
+    async def _query(self, transport: Elm327Transport, cmd: str) -> memoryview:
+        start = monotonic()
+        resp = await super()._query(transport, cmd)
+        if self._measuring:
+            self._latencies[cmd].append(monotonic() - start)
+            if resp is None:
+                self._failures[cmd] += 1
+        return resp
+
+    def _publish_values(self, d: dict):
+        super()._publish_values(d)
+        self._frames += 1
+
+    @property
+    def metrics(self) -> Metrics:
+        return self._metrics
+
+    def report(self) -> str:
+        elapsed = self._elapsed or float('nan')
+        published = sum(self._redis.published.values())
+        lines = ["{} frames in {:.1f} sec: {:.1f} frames/sec, {:.1f} values/sec".format(
+            self._frames, elapsed, self._frames / elapsed, published / elapsed),
+            "{:<20} {:>8} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+                'Query', 'Count', 'Failed', 'Avg ms', 'P50 ms', 'P95 ms', 'Max ms')]
+        if self._redis.stream_entries:
+            lines.insert(1, "{} stream entries: {:.1f} entries/sec".format(
+                self._redis.stream_entries, self._redis.stream_entries / elapsed))
+        for cmd, durations in sorted(self._latencies.items()):
+            d = sorted(durations)
+            lines.append("{:<20} {:>8} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+                cmd, len(d), self._failures[cmd],
+                sum(d) / len(d) * 1000,
+                d[len(d) // 2] * 1000,
+                d[min(int(len(d) * 0.95), len(d) - 1)] * 1000,
+                d[-1] * 1000))
+        return '\n'.join(lines)
+
+
+def run_benchmark(config: ConfigParser, emulator: Elm327Emulator, duration: float) -> BenchmarkDaemon:
+    """
+    Runs the serial daemon against the emulator for the given duration
+    """
+    config.set('OBD', 'Path', emulator.path)
+    daemon = BenchmarkDaemon(duration)
+    daemon.set_config(config)
+    try:
+        daemon.startup()
+    except CarPiExitException:
+        pass
+    finally:
+        daemon.shutdown()
+    return daemon
+
+
+def _build_config(file: str, overrides: list) -> ConfigParser:
+    config = ConfigParser()
+    config.read_dict(BENCHMARK_CONFIG)
+    if file:
+        with open(file) as f:
+            config.read_file(f)
+    for override in overrides:
+        key, value = override.split('=', 1)
+        section, option = key.split('.', 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+    return config
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks the serial daemon against an emulated ELM327')
+    parser.add_argument('--duration', type=float, default=10, help='Time to measure in [sec]')
+    parser.add_argument('--protocol', default='6', help='Emulated protocol (6 - 9 are CAN)')
+    parser.add_argument('--latency', type=float, default=0.01, help='Response latency in [sec]')
+    parser.add_argument('--jitter', type=float, default=0, help='Max. random latency added in [sec]')
+    parser.add_argument('--response-wait', type=float, default=0,
+                        help='Time in [sec] the adapter waits for further ECUs without a response count')
+    parser.add_argument('--error-rate', type=float, default=0, help='Probability of a failing request')
+    parser.add_argument('--errors', nargs='+', choices=ALL_ERRORS, default=ALL_ERRORS)
+    parser.add_argument('--monitor-rate', type=float, default=100,
+                        help='CAN frames per second broadcast while monitoring (Monitor.Enabled=1)')
+    parser.add_argument('--buffer-full-rate', type=float, default=0,
+                        help='Probability of a broadcast frame overrunning the adapter\'s buffer')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--config', default=None, help='Daemon configuration to use')
+    parser.add_argument('--metrics', action='store_true', help='Prints the daemon\'s metrics')
+    parser.add_argument('--set', action='append', default=[], metavar='SECTION.KEY=VALUE',
+                        help='Overrides a configuration value, e.g. OBD.FastMode=1')
+    args = parser.parse_args()
+
+    with Elm327Emulator(protocol=args.protocol,
+                        latency=args.latency,
+                        jitter=args.jitter,
+                        response_wait=args.response_wait,
+                        error_rate=args.error_rate,
+                        errors=args.errors,
+                        monitor_rate=args.monitor_rate,
+                        buffer_full_rate=args.buffer_full_rate,
+                        seed=args.seed) as emu:
+        daemon = run_benchmark(_build_config(args.config, args.set), emu, args.duration)
+        print(daemon.report())
+        if args.metrics and daemon.metrics:
+            print(daemon.metrics.dump())
@@ -0,0 +1,140 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+"""
+import json
+from os import makedirs, replace
+from os.path import dirname, exists
+from time import time
+
+from carpicommons.log import logger
+
+from obddaemon.custom.Obd2DataParser import trim_obd_value, MODE_01_REQUEST
+
+log = logger('OBD Capabilities')
+
+SUPPORT_BITMAP_PIDS = ['0100', '0120', '0140', '0160', '0180', '01A0', '01C0']
+
+VIN_LENGTH = 17
+
+
+def _response_lines(v):
+    """
+    Returns the lines of a response, multi-frame line numbers and byte counts removed
+    :param str v:
+    :return list:
+    """
+    lines = []
+    for line in (v or '').split('\n'):
+        line = line.strip()
+        if not line or line.endswith('...') or (len(line) == 3 and not lines):
+            continue
+        if len(line) > 2 and line[1] == ':':
+            line = line[2:]
+        lines.append(line)
+    return lines
+
+
+def parse_support_bitmap(cmd, v):
+    """
+    Parses the response to a "PIDs supported" request (0100, 0120, ...)
+    and returns the supported Mode 01 PIDs. Responses of several ECUs are merged.
+    :param str cmd: e.g. "0100"
+    :param str v: e.g. "4100BE3EB811"
+    :return set: e.g. {"0101", "0103", ...}
+    """
+    base = int(cmd[2:], 16)
+    supported = set()
+    for line in _response_lines(v):
+        try:
+            bitmap = int(trim_obd_value(line)[:8], 16)
+        except ValueError:
+            continue
+        for i in range(32):
+            if bitmap & (1 << (31 - i)):
+                supported.add('{}{:02X}'.format(MODE_01_REQUEST, base + i + 1))
+    return supported
+
+
+def parse_vin(v):
+    """
+    Parses the response to a VIN request (0902)
+    :param str v: e.g. "014\\n0:490201314731\\n1:4A433534343452\\n2:37323532333637"
+    :return str: VIN or None if the response does not contain one
+    """
+    lines = _response_lines(v)
+    if len(lines) > 1 and all(l.startswith('4902') for l in lines):
+        # one message per line, each with a sequence number (ISO 9141 / KWP)
+        data = ''.join([l[6:] for l in lines])
+    else:
+        joined = ''.join(lines)
+        i = joined.find('4902')
+        data = joined[i + 6:] if i >= 0 else ''
+
+    try:
+        chars = bytes.fromhex(data[:len(data) // 2 * 2]).decode('ascii', 'ignore')
+    except ValueError:
+        return None
+    vin = ''.join([c for c in chars if c.isalnum()])
+    return vin[-VIN_LENGTH:] if len(vin) >= VIN_LENGTH else None
+
+
+def ecu_id(protocol, v):
+    """
+    Builds an ID of a vehicle without VIN from the response to 0100,
+    ignoring the lines printed while searching for the protocol (e.g. "SEARCHING...", "BUS INIT: ...OK")
+    :param str protocol: Protocol number as reported by ATDPN
+    :param str v: e.g. "SEARCHING...\n4100BE3EB811"
+    :return str: e.g. "ECU-6-4100BE3EB811", None if the response contains no bitmap
+    """
+    bitmaps = sorted(set(l for l in _response_lines(v) if l.startswith('4100')))
+    return 'ECU-{}-{}'.format(protocol, '-'.join(bitmaps)) if bitmaps else None
+
+
+def matches_bitmap(first, supported):
+    """
+    Returns True if the supported PIDs are the ones reported by the response to 0100
+    :param str first: Response to 0100
+    :param set supported: Supported PIDs, e.g. from the CapabilityCache
+    """
+    return parse_support_bitmap(SUPPORT_BITMAP_PIDS[0], first) == \
+        {c for c in supported if int(c[2:], 16) <= 0x20}
+
+
+class CapabilityCache(object):
+    """
+    Stores the supported PIDs per vehicle in a JSON file
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._data = {}
+        if path and exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self._data = json.load(f)
+            except (IOError, ValueError):
+                log.warning("Failed to read capability cache %s, ignoring it", path)
+
+    def get(self, vehicle: str) -> set:
+        entry = self._data.get(vehicle)
+        return set(entry['supported']) if entry else None
+
+    def put(self, vehicle: str, supported: set):
+        self._data[vehicle] = {
+            'supported': sorted(supported),
+            'updated': time()
+        }
+        if not self._path:
+            return
+
+        try:
+            if dirname(self._path):
+                makedirs(dirname(self._path), exist_ok=True)
+            tmp = self._path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self._data, f, indent=2, sort_keys=True)
+            replace(tmp, self._path)
+        except IOError:
+            log.warning("Failed to write capability cache %s", self._path)
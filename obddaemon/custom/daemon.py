@@ -3,26 +3,34 @@ CARPI OBD II DAEMON
 (C) 2018, Raphael "rGunti" Guntersweiler
 Licensed under MIT
 """
-from logging import Logger
-from math import isnan
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from logging import DEBUG
+from math import isnan, ceil
 from os.path import exists
 from pprint import pprint
-from time import sleep
+from time import sleep, monotonic
 
 from carpicommons.errors import CarPiExitException
 
 import obddaemon.keys as ObdKeys
 
 from carpicommons.log import logger
-from daemoncommons.daemon import Daemon
-from redisdatabus.bus import BusWriter
 from serial import Serial, SerialException
 
 import obddaemon.custom.errors as errors
-from obddaemon.custom.Obd2DataParser import parse_obj, parse_value
+from obddaemon.base import ObdBaseDaemon
+from obddaemon.metrics import STAGE_SEND, STAGE_DECODE, COUNTER_TIMEOUT, COUNTER_EMPTY, \
+    COUNTER_PARSE_FAILURE, COUNTER_BUFFER_FULL, COUNTER_MONITOR_FRAMES, COUNTER_MONITOR_ERRORS
+from obddaemon.custom.capabilities import CapabilityCache, parse_support_bitmap, parse_vin, \
+    ecu_id, matches_bitmap, SUPPORT_BITMAP_PIDS
+from obddaemon.custom.monitor import CanMonitor, MonitorMapping, ID_LENGTHS
+from obddaemon.custom.transport import Elm327Transport
+from obddaemon.custom.Obd2DataParser import is_mode_01, build_multi_pid_request, \
+    parse_response, parse_multi_pid_response, response_frames, MAX_PIDS_PER_REQUEST, MODE_01_REQUEST
 
 
-class SerialObdDaemon(Daemon):
+class SerialObdDaemon(ObdBaseDaemon):
     INIT_SEQUENCE = [
         'ATZ',   # reset all settings
         'ATE0',  # don't echo input
@@ -31,6 +39,15 @@ class SerialObdDaemon(Daemon):
         'ATSI',  # perform slow initialization
     ]
 
+    # cheap probe whether an adapter initialized before is still responding
+    PROBE = 'ATI'
+
+    # initialization after a reconnect, the negotiated protocol is set by ATSP
+    WARM_INIT_SEQUENCE = [
+        'ATE0',
+        'ATS0'
+    ]
+
     FETCH_SEQUENCE = [
         'ATRV',  # Battery Voltage
         '0103',  # Fuel System
@@ -41,6 +58,25 @@ class SerialObdDaemon(Daemon):
         '010F'   # Intake Air Temp
     ]
 
+    HOUSEKEEPING_INTERVAL = 1.0
+
+    # supported by every vehicle, used to measure the latency per query
+    LATENCY_PROBE = '0100'
+
+    # attempts of letting the adapter search for the protocol, while ATDPN still reports 0
+    PROTOCOL_DETECTION_ATTEMPTS = 3
+
+    # consecutive failed multi PID requests after which only single PID requests are sent
+    MULTI_PID_MAX_FAILURES = 3
+
+    # ISO 15765-4 (CAN) protocols as reported by ATDPN, these accept multi PID requests
+    CAN_PROTOCOLS = ['6', '7', '8', '9']
+
+    MONITOR_SEQUENCE = [
+        'ATH1',   # print headers (CAN IDs)
+        'ATCAF0'  # no CAN auto formatting, print all data bytes
+    ]
+
     OBD_MAPPING = {
         'ATRV': ObdKeys.KEY_VOLTAGE,
         '0103': ObdKeys.KEY_FUEL_STATUS,
@@ -52,23 +88,25 @@ class SerialObdDaemon(Daemon):
 
     def __init__(self):
         super().__init__("SerOBD Daemon")
-        self._log: Logger = None
-        self._bus: BusWriter = None
         self._serial: Serial = None
         self._running = False
-
-    def _build_bus_writer(self) -> BusWriter:
-        self._log.info("Connecting to Redis instance ...")
-        return BusWriter(host=self._get_config('Redis', 'Host', '127.0.0.1'),
-                         port=self._get_config_int('Redis', 'Port', 6379),
-                         db=self._get_config_int('Redis', 'DB', 0),
-                         password=self._get_config('Redis', 'Password', None))
+        self._multi_pid = False
+        self._multi_pid_failures = 0
+        self._timeout = 1.0
+        self._vehicle_id: str = None
+        self._capabilities: CapabilityCache = None
+        self._fast_mode = False
+        # responses (frames) expected per Mode 01 request in fast mode, computed on first use
+        self._response_counts = {}
+        self._ecus = 1
+        # protocol negotiated by the last cold initialization (ATDPN)
+        self._protocol: str = None
 
     def startup(self):
         self._log = log = logger(self.name)
         log.info("Starting up %s ...", self.name)
 
-        self._bus = bus = self._build_bus_writer()
+        self._setup_bus()
 
         device = self._get_config('OBD', 'Path', None)
         baudrate = self._get_config_int('OBD', 'Baudrate', 9600)
@@ -85,79 +123,492 @@ class SerialObdDaemon(Daemon):
             log.error("Device %s could not be found!", device)
             raise errors.SerialObdDeviceNotFound()
 
+        self._timeout = timeout
+
         retries = 5
+        attempt = 0
         while retries > 0:
+            self._running = False
             try:
                 log.info("Connecting ...")
                 with Serial(device,
                             baudrate=baudrate,
-                            timeout=timeout) as ser:
+                            timeout=0) as ser:
                     self._serial = ser
-                    # sio = TextIOWrapper(BufferedRWPair(ser, ser))
-
-                    ser.write(b'\r')
-                    # log.debug("Awaiting response ...")
-                    # ser.read_until(b'\r')
-
-                    log.debug("Connection established, running initialization ...")
-                    log.info("Running initialization ...")
-                    for cmd in SerialObdDaemon.INIT_SEQUENCE:
-                        self.send_and_wait(ser, cmd)
-
-                    log.info("Initialization completed, starting data fetching ...")
+                    loop = asyncio.new_event_loop()
                     try:
-                        while True:
-                            d = dict()
-                            for c in SerialObdDaemon.FETCH_SEQUENCE:
-                                v = self.send_and_wait(ser, c)
-                                p = parse_obj({c: v})
-                                d[c] = p[c]
-
-                                val = d[c]
-                                if val is not None:
-                                    bus.publish(SerialObdDaemon.OBD_MAPPING[c], val)
-
-                            if self._get_config_bool('Console', 'DoPprint', False):
-                                pprint(d)
-                            sleep(0.5)
+                        loop.run_until_complete(self._run(Elm327Transport(ser)))
                     except (KeyboardInterrupt, SystemExit) as e:
                         log.info("Terminating connection upon user request")
                         ser.close()
                         raise e
+                    finally:
+                        loop.close()
 
                 self._serial = None
             except CarPiExitException as e:
                 raise e
             except SerialException as e:
-                log.error("Serial connection error")
+                log.error("Serial connection error: %s", e)
             except Exception as e:
-                log.error("Error while communicating with Serial device", e)
+                log.error("Error while communicating with Serial device: %s", e)
+
+            if self._running:
+                # the connection was lost while fetching data, start over
+                retries = 5
+                attempt = 0
 
             retries -= 1
-            log.info("Retrying in 5 seconds, repeating %s more times", retries)
             if retries:
-                sleep(5)
+                delay = self._reconnect_delay(attempt)
+                attempt += 1
+                log.info("Retrying in %.1f seconds, repeating %s more times", delay, retries)
+                sleep(delay)
+
+    async def _run(self, transport: Elm327Transport):
+        log = self._log
+        self._serial.write(b'\r')
+        transport.discard_pending()
+
+        log.debug("Connection established, running initialization ...")
+        protocol = await self._warm_init(transport) if self._protocol else None
+        # response to the first support bitmap request (0100), sent by the protocol detection
+        first = None
+        if not protocol:
+            log.info("Running initialization ...")
+            for cmd in SerialObdDaemon.INIT_SEQUENCE:
+                await self.send_and_wait(transport, cmd)
+
+            protocol, first = await self._detect_protocol(transport)
+        if self._get_config_bool('Monitor', 'Enabled', False):
+            if protocol in SerialObdDaemon.CAN_PROTOCOLS:
+                self._protocol = protocol
+                await self._run_tasks(self._monitor, transport, protocol)
+                return
+            log.error("Monitor mode requires a CAN protocol, protocol %s is in use, "
+                      "polling instead", protocol)
 
-    def send_and_wait(self, ser: Serial, cmd: str) -> str:
-        self._log.debug(" - Sending: %s", cmd)
+        sequence = SerialObdDaemon.FETCH_SEQUENCE
+        if self._get_config_bool('OBD', 'DiscoverPids', True):
+            supported = await self._discover_supported_pids(transport, protocol, first)
+            if supported:
+                sequence = [c for c in sequence if not is_mode_01(c) or c in supported]
+                for c in SerialObdDaemon.FETCH_SEQUENCE:
+                    if c not in sequence:
+                        log.info("%s is not supported by this vehicle and will not be polled", c)
 
-        enc = str.encode("{}\r".format(cmd))
+        if not protocol or protocol == '0':
+            # the discovery requests may have completed the search
+            protocol = await self._read_protocol(transport)
+        if protocol and protocol != '0':
+            # only a protocol settled by OBD requests is selected again on a warm reconnect
+            self._protocol = protocol
+
+        self._multi_pid = self._get_config_bool('OBD', 'MultiPid', True) \
+            and self._supports_multi_pid(protocol)
+        self._multi_pid_failures = 0
+
+        if self._get_config_bool('OBD', 'FastMode', False):
+            await self._enable_fast_mode(transport, protocol, sequence)
+
+        self._scheduler = self._build_scheduler(
+            {c: SerialObdDaemon.OBD_MAPPING[c] for c in sequence})
+
+        log.info("Initialization completed, starting data fetching ...")
+        await self._run_tasks(self._acquire, transport)
+
+    async def _run_tasks(self, acquire, *args):
+        """
+        Runs the data acquisition along with the housekeeping
+        :param acquire: Acquisition coroutine function, called with args and the publisher executor
+        """
+        # everything touching the bus runs in order on a single publisher thread
+        executor = ThreadPoolExecutor(max_workers=1)
+        housekeeping = asyncio.ensure_future(self._run_housekeeping(executor))
+        try:
+            await acquire(*args, executor)
+        finally:
+            housekeeping.cancel()
+            executor.shutdown()
+
+    async def _acquire(self, transport: Elm327Transport, executor: ThreadPoolExecutor):
+        loop = asyncio.get_event_loop()
+        scheduler = self._scheduler
+        publishing = None
+        self._running = True
+        while self._running:
+            await asyncio.sleep(scheduler.delay())
+
+            d = dict()
+            for cmds in self._build_fetch_plan(scheduler.due(), self._multi_pid):
+                d.update(await self._fetch(transport, cmds))
+                for c in cmds:
+                    scheduler.mark_polled(c)
+
+            # publishing the previous frame ran while this one was being acquired
+            if publishing:
+                await publishing
+            publishing = loop.run_in_executor(executor, self._publish_frame, d)
+
+            if self._get_config_bool('Console', 'DoPprint', False):
+                pprint(d)
+
+        if publishing:
+            await publishing
+
+    async def _run_housekeeping(self, executor: ThreadPoolExecutor):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(SerialObdDaemon.HOUSEKEEPING_INTERVAL)
+            self._report_poll_rates()
+            await loop.run_in_executor(executor, self._report_publish_filter)
+            await loop.run_in_executor(executor, self._report_metrics)
+            await loop.run_in_executor(executor, self._publish_aggregates)
+
+    def _publish_frame(self, d: dict):
+        self._publish_values({SerialObdDaemon.OBD_MAPPING[c]: val for c, val in d.items()})
+
+    def _publish_values(self, d: dict):
+        """
+        Publishes the values of a frame, given per channel
+        """
+        for channel, val in d.items():
+            if val is not None:
+                self._publish(channel, val)
+        self._flush_bus()
+
+    def _build_monitor(self, protocol: str) -> CanMonitor:
+        mappings = []
+        if self._config.has_section('MonitorMap'):
+            for name, v in self._config.items('MonitorMap'):
+                try:
+                    mappings.append(MonitorMapping.parse(name, v))
+                except ValueError:
+                    self._log.error("Ignoring invalid monitor mapping %s=%s", name, v)
+        return CanMonitor(mappings, ID_LENGTHS[protocol])
+
+    async def _monitor(self, transport: Elm327Transport, protocol: str, executor: ThreadPoolExecutor):
+        """
+        Streams the broadcast traffic on the CAN bus (ATMA) and publishes the mapped signals
+        """
+        log = self._log
+        loop = asyncio.get_event_loop()
+        monitor = self._build_monitor(protocol)
+
+        cmds = list(SerialObdDaemon.MONITOR_SEQUENCE)
+        receive_filter = self._get_config('Monitor', 'Filter', None)
+        if receive_filter:
+            cmds.append('ATCRA{}'.format(receive_filter))
+        for cmd in cmds:
+            resp = await self.send_and_wait(transport, cmd)
+            if not resp or not resp.endswith('OK'):
+                log.warning("Adapter did not accept %s (%s)", cmd, resp)
+
+        log.info("Monitoring CAN bus (protocol %s, filter %s) ...", protocol, receive_filter or 'none')
+        metrics = self._metrics
+        timeout = self._get_config_float('OBD', 'Timeout', 1)
+        publishing = None
+        self._running = True
+        transport.send('ATMA')
+        while self._running:
+            frames, errors, buffer_full = monitor.frames, monitor.errors, monitor.buffer_full
+            try:
+                # a silent bus must not keep the loop from noticing a shutdown
+                chunk = await asyncio.wait_for(transport.read_available(), timeout)
+            except asyncio.TimeoutError:
+                continue
+            values, stopped = monitor.feed(chunk)
+            if values:
+                if publishing:
+                    await publishing
+                publishing = loop.run_in_executor(executor, self._publish_values, values)
 
-        ser.write(enc)
-        ser.flush()
-        resp = ser.read_until(b'\r>')
+            if stopped:
+                log.warning("Adapter stopped monitoring (%s x BUFFER FULL so far), restarting; "
+                            "narrow the filter or raise the baudrate", monitor.buffer_full)
+                monitor.reset()
+                transport.send('ATMA')
 
-        if not resp or resp.startswith(b'\xff'):
-            self._log.warning(" - [%s] =x Empty or invalid response, connection might be failing soon")
+            if metrics:
+                metrics.increment(COUNTER_MONITOR_FRAMES, 'ATMA', monitor.frames - frames)
+                if monitor.errors > errors:
+                    metrics.increment(COUNTER_MONITOR_ERRORS, 'ATMA', monitor.errors - errors)
+                if monitor.buffer_full > buffer_full:
+                    metrics.increment(COUNTER_BUFFER_FULL, 'ATMA', monitor.buffer_full - buffer_full)
+
+        # any character stops monitoring
+        transport.send('')
+        transport.discard_pending()
+        if publishing:
+            await publishing
+
+    async def _warm_init(self, transport: Elm327Transport) -> str:
+        """
+        Reuses the adapter's state after a reconnect: skips the reset and the slow initialization
+        if the adapter still responds and selects the protocol negotiated before (ATSP)
+        :return: Protocol or None if a cold initialization is required
+        """
+        log = self._log
+        log.info("Trying warm reconnect using protocol %s ...", self._protocol)
+        probe = await self.send_and_wait(transport, SerialObdDaemon.PROBE)
+        if not probe or probe.endswith('?'):
+            log.info("Adapter did not respond, running cold initialization")
             return None
+
+        for cmd in SerialObdDaemon.WARM_INIT_SEQUENCE + ['ATSP{}'.format(self._protocol)]:
+            resp = await self.send_and_wait(transport, cmd)
+            if not resp or not resp.endswith('OK'):
+                log.info("Adapter did not accept %s (%s), running cold initialization", cmd, resp)
+                return None
+        return self._protocol
+
+    async def _detect_protocol(self, transport: Elm327Transport) -> (str, str):
+        """
+        Returns the protocol in use ('0' if the adapter did not find one) and the response to 0100.
+        In automatic mode an ELM327 only searches for the protocol on the first
+        OBD request and reports 0 (A0) until then, so a Mode 01 request comes first.
+        """
+        protocol = first = None
+        for _ in range(SerialObdDaemon.PROTOCOL_DETECTION_ATTEMPTS):
+            first = await self.send_and_wait(transport, SUPPORT_BITMAP_PIDS[0])
+            protocol = await self._read_protocol(transport)
+            if protocol and protocol != '0':
+                return protocol, first
+            self._log.info("Adapter did not find a protocol yet (%s), retrying", protocol)
+        return protocol, first
+
+    async def _read_protocol(self, transport: Elm327Transport) -> str:
+        # "A6" while in automatic mode
+        protocol = await self.send_and_wait(transport, 'ATDPN')
+        return protocol.lstrip('A') if protocol else None
+
+    def _supports_multi_pid(self, protocol: str) -> bool:
+        if protocol in SerialObdDaemon.CAN_PROTOCOLS:
+            self._log.info("Protocol %s supports multi PID requests", protocol)
+            return True
         else:
-            resp = resp.decode('utf-8') \
-                .replace('\r', '\n') \
-                .replace('>', '') \
-                .strip()
+            self._log.info("Protocol %s does not support multi PID requests, "
+                           "using single PID requests", protocol)
+            return False
+
+    async def _discover_supported_pids(self, transport: Elm327Transport, protocol: str, first: str = None) -> set:
+        """
+        Returns the Mode 01 PIDs supported by the vehicle, read from the capability cache
+        or queried from the support bitmaps (0100, 0120, ...) if the vehicle is unknown.
+        Returns None if the supported PIDs could not be determined.
+        :param first: Response to 0100 if already sent, None after a warm reconnect
+        """
+        log = self._log
+        if self._capabilities is None:
+            # kept across reconnects, also if not stored on disk
+            self._capabilities = CapabilityCache(self._get_config('OBD', 'CapabilityCache', None))
+        cache = self._capabilities
+
+        # a reconnect to the vehicle identified before needs no requests,
+        # after a reset the first bitmap has to match the cached PIDs
+        cached = cache.get(self._vehicle_id) if self._vehicle_id else None
+        if cached and (first is None or matches_bitmap(first, cached)):
+            log.info("Using cached list of %s supported PIDs of %s", len(cached), self._vehicle_id)
+            return cached
+
+        if first is None:
+            first = await self.send_and_wait(transport, SUPPORT_BITMAP_PIDS[0])
+        supported = parse_support_bitmap(SUPPORT_BITMAP_PIDS[0], first)
+        if not supported:
+            log.warning("Vehicle did not report its supported PIDs")
+            return None
+
+        vin = parse_vin(await self.send_and_wait(transport, '0902'))
+        self._vehicle_id = vehicle = vin or ecu_id(protocol, first) or 'ECU-{}'.format(protocol)
+        log.info("Vehicle identified as %s", vehicle)
+
+        # the bitmap also guards against a VIN shared by vehicles with different equipment
+        cached = cache.get(vehicle)
+        if cached and matches_bitmap(first, cached):
+            log.info("Using cached list of %s supported PIDs", len(cached))
+            return cached
+
+        for cmd, next_cmd in zip(SUPPORT_BITMAP_PIDS, SUPPORT_BITMAP_PIDS[1:]):
+            if next_cmd not in supported:
+                break
+            supported |= parse_support_bitmap(next_cmd, await self.send_and_wait(transport, next_cmd))
+
+        log.info("Vehicle supports %s PIDs", len(supported))
+        cache.put(vehicle, supported)
+        return supported
+
+    async def _enable_fast_mode(self, transport: Elm327Transport, protocol: str, sequence: list):
+        """
+        Tunes the adapter for low latency: adaptive timing, a shorter response timeout,
+        optionally addressing only one ECU, and Mode 01 requests (single and multi PID)
+        carrying the expected number of responses so the adapter does not wait for more ECUs.
+        :param sequence: Commands to poll
+        """
+        log = self._log
+        requests = [cmds[0] if len(cmds) == 1 else build_multi_pid_request(cmds)
+                    for cmds in self._build_fetch_plan([c for c in sequence if is_mode_01(c)], self._multi_pid)]
+        # measured on a request as sent by polling
+        probe = requests[0] if requests else SerialObdDaemon.LATENCY_PROBE
+        before = await self._measure_latency(transport, probe)
+
+        cmds = ['ATAT{}'.format(self._get_config_int('OBD', 'AdaptiveTiming', 2))]
+        response_timeout = self._get_config_int('OBD', 'ResponseTimeoutMs', 0)
+        if response_timeout > 0:
+            # ATST takes the timeout in units of 4 ms
+            cmds.append('ATST{:02X}'.format(min(max(ceil(response_timeout / 4), 1), 0xFF)))
+        header = self._get_config('OBD', 'Header', None)
+        if header:
+            cmds.append('ATSH{}'.format(header))
+        receive_filter = self._get_config('OBD', 'ReceiveFilter', None)
+        if receive_filter:
+            cmds.append('{}{}'.format('ATCRA' if protocol in SerialObdDaemon.CAN_PROTOCOLS else 'ATSR',
+                                      receive_filter))
+
+        for cmd in cmds:
+            resp = await self.send_and_wait(transport, cmd)
+            if not resp or not resp.endswith('OK'):
+                log.warning("Adapter did not accept %s (%s)", cmd, resp)
+
+        # every responding ECU answers 0100 with one frame
+        self._ecus = self._count_ecus(await self.send_and_wait(transport, SerialObdDaemon.LATENCY_PROBE))
+        self._response_counts = {}
+        log.info("%s ECU(s) responding", self._ecus)
+
+        self._fast_mode = True
+        after = await self._measure_latency(transport, self._counted_request(probe))
+        log.info("Fast mode enabled, latency per %s request: %.1f ms before, %.1f ms after",
+                 probe, before * 1000, after * 1000)
 
-        self._log.debug(" - [%s] => %s", cmd, resp)
+    @staticmethod
+    def _count_ecus(resp: str) -> int:
+        """
+        Returns the number of ECUs which answered 0100, at least 1
+        """
+        return max(len([line for line in (resp or '').split('\n') if line.strip().startswith('4100')]), 1)
+
+    async def _measure_latency(self, transport: Elm327Transport, cmd: str, samples: int = 3) -> float:
+        durations = []
+        for _ in range(samples):
+            start = monotonic()
+            if await self._query(transport, cmd) is not None:
+                durations.append(monotonic() - start)
+        return sum(durations) / len(durations) if durations else float('nan')
+
+    def _counted_request(self, request: str) -> str:
+        # in fast mode the adapter returns as soon as the expected responses (frames) arrived
+        if not self._fast_mode or not request.startswith(MODE_01_REQUEST):
+            return request
+        counted = self._response_counts.get(request)
+        if counted is None:
+            frames = response_frames(request, self._protocol in SerialObdDaemon.CAN_PROTOCOLS)
+            count = frames * self._ecus if frames else 0
+            # the count is a single hex digit, without one the adapter waits for its timeout
+            counted = self._response_counts[request] = \
+                '{}{:X}'.format(request, count) if 0 < count <= 0xF else request
+        return counted
+
+    @staticmethod
+    def _build_fetch_plan(sequence: list, batch: bool) -> list:
+        """
+        Groups the given commands into requests, every request being a list of
+        commands. Mode 01 PIDs are grouped into multi PID requests if batch is set.
+        """
+        plan = []
+        group = []
+        for c in sequence:
+            if batch and is_mode_01(c):
+                group.append(c)
+                if len(group) >= MAX_PIDS_PER_REQUEST:
+                    plan.append(group)
+                    group = []
+            else:
+                plan.append([c])
+        if group:
+            plan.append(group)
+        return plan
+
+    async def _fetch(self, transport: Elm327Transport, cmds: list) -> dict:
+        if len(cmds) == 1:
+            c = cmds[0]
+            resp = await self._query(transport, self._counted_request(c))
+            start = monotonic()
+            d = {c: parse_response(c, resp)}
+            self._record_decode(c, start, resp, d)
+            return d
+
+        request = build_multi_pid_request(cmds)
+        resp = await self._query(transport, self._counted_request(request))
+        start = monotonic()
+        d = parse_multi_pid_response(cmds, resp)
+        self._record_decode(request, start, resp, d)
+        if not all(v is None for v in d.values()):
+            self._multi_pid_failures = 0
+            return d
+
+        # a single failure (NO DATA, a timeout, a garbled frame) only affects this cycle
+        self._multi_pid_failures += 1
+        rejected = resp is not None and bytes(resp).replace(b'>', b'').strip() == b'?'
+        if rejected or self._multi_pid_failures >= SerialObdDaemon.MULTI_PID_MAX_FAILURES:
+            self._log.warning("Multi PID request for %s %s, using single PID requests from now on",
+                              cmds, 'rejected by the adapter' if rejected
+                              else 'failed {} times in a row'.format(self._multi_pid_failures))
+            self._multi_pid = False
+        else:
+            self._log.debug("Multi PID request for %s failed, falling back to single PID requests", cmds)
+        for c in cmds:
+            d.update(await self._fetch(transport, [c]))
+        return d
+
+    def _record_decode(self, name: str, start: float, resp, d: dict):
+        metrics = self._metrics
+        if not metrics or resp is None:
+            return
+        metrics.observe(STAGE_DECODE, name, monotonic() - start)
+        for c, v in d.items():
+            if v is None or (isinstance(v, tuple) and all(x is None for x in v)):
+                metrics.increment(COUNTER_PARSE_FAILURE, c)
+
+    async def _query(self, transport: Elm327Transport, cmd: str) -> memoryview:
+        """
+        Sends a command and returns the raw response,
+        the response is only valid until the next command is sent
+        """
+        log = self._log
+        log.debug(" - Sending: %s", cmd)
+
+        metrics = self._metrics
+        start = monotonic()
+        try:
+            resp = await transport.send_and_wait(cmd, self._timeout)
+        except asyncio.TimeoutError:
+            if metrics:
+                metrics.increment(COUNTER_TIMEOUT, cmd)
+            resp = None
+        duration = monotonic() - start
+
+        if not resp or resp[0] == 0xFF:
+            log.warning(" - [%s] =x Empty or invalid response, connection might be failing soon", cmd)
+            if metrics and resp is not None:
+                metrics.increment(COUNTER_EMPTY, cmd)
+            return None
+
+        if metrics:
+            metrics.observe(STAGE_SEND, cmd, duration)
+
+        if log.isEnabledFor(DEBUG):
+            log.debug(" - [%s] => %s (%.1f ms)", cmd, bytes(resp), duration * 1000)
         return resp
 
+    async def send_and_wait(self, transport: Elm327Transport, cmd: str) -> str:
+        resp = await self._query(transport, cmd)
+        if resp is None:
+            return None
+
+        return bytes(resp).decode('utf-8') \
+            .replace('\r', '\n') \
+            .replace('>', '') \
+            .strip()
+
     def shutdown(self):
         super().shutdown()
+        self._running = False
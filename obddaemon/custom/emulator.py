@@ -0,0 +1,350 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+ELM327 emulator on a pseudo terminal, its path can be used as [OBD] Path
+to run the serial daemon without an adapter and a vehicle.
+"""
+import os
+import tty
+from math import sin
+from random import Random
+from select import select
+from threading import Thread
+from time import sleep, monotonic
+
+from carpicommons.log import logger
+
+ERROR_NO_DATA = 'NO DATA'
+ERROR_UNABLE_TO_CONNECT = 'UNABLE TO CONNECT'
+ERROR_GARBAGE = 'GARBAGE'
+
+ALL_ERRORS = [ERROR_NO_DATA, ERROR_UNABLE_TO_CONNECT, ERROR_GARBAGE]
+
+CAN_PROTOCOLS = ['6', '7', '8', '9']
+
+DEFAULT_VIN = '1G1JC5444R7252367'
+
+
+def _wave(t: float, period: float, low: float, high: float) -> float:
+    return low + (high - low) * (sin(t * 6.283 / period) + 1) / 2
+
+
+# Mode 01 PIDs of the emulated vehicle: data bytes as function of the time in [sec]
+DEFAULT_PIDS = {
+    0x01: lambda t: bytes([0x00, 0x07, 0xE5, 0x00]),                # monitor status
+    0x03: lambda t: bytes([0x02, 0x00]),                            # fuel system: closed loop
+    0x04: lambda t: bytes([int(_wave(t, 7, 20, 80) * 2.55)]),       # engine load
+    0x05: lambda t: bytes([min(int(t) + 60, 130)]),                 # coolant temp, warming up
+    0x0B: lambda t: bytes([int(_wave(t, 7, 30, 100))]),             # intake MAP
+    0x0C: lambda t: int(_wave(t, 11, 800, 4500) * 4).to_bytes(2, 'big'),  # RPM
+    0x0D: lambda t: bytes([int(_wave(t, 30, 0, 120))]),             # speed
+    0x0F: lambda t: bytes([65]),                                    # intake air temp: 25 C
+}
+
+# Frames broadcast on the CAN bus while monitoring (ATMA): data bytes per 11 bit ID as function of the time
+DEFAULT_BROADCASTS = {
+    '201': lambda t: int(_wave(t, 11, 800, 4500) * 4).to_bytes(2, 'big')   # RPM * 4
+                     + int(_wave(t, 30, 0, 120) * 100).to_bytes(2, 'big')  # speed * 100
+                     + bytes(4),
+    '420': lambda t: bytes([min(int(t) + 60, 130), 0, 0, 0, 0, 0, 0, 0]),  # coolant temp + 40
+    '4B0': lambda t: bytes(8),                                            # wheel speeds, standing still
+}
+
+
+class Elm327Emulator(object):
+    """
+    Answers AT commands, Mode 01 requests (multi PID requests on CAN protocols),
+    the supported PIDs bitmaps, ATRV and the VIN (0902) like an ELM327 adapter
+    connected to a vehicle. Broadcasts CAN frames while monitoring (ATMA).
+    Runs in a background thread, errors can be injected randomly into OBD responses.
+    """
+    PROMPT = '>'
+    # CAN frames carry 7 data bytes, the first frame of a multi-frame message 6
+    SINGLE_FRAME_BYTES = 7
+    FIRST_FRAME_BYTES = 6
+
+    def __init__(self,
+                 protocol: str = '6',
+                 latency: float = 0.01,
+                 jitter: float = 0,
+                 response_wait: float = 0,
+                 error_rate: float = 0,
+                 errors: list = None,
+                 pids: dict = None,
+                 vin: str = DEFAULT_VIN,
+                 voltage: float = 12.6,
+                 broadcasts: dict = None,
+                 monitor_rate: float = 100,
+                 buffer_full_rate: float = 0,
+                 seed: int = None):
+        """
+        :param protocol: Protocol number as reported by ATDPN (6 - 9 are CAN)
+        :param latency: Time in [sec] the vehicle takes to answer an OBD request
+        :param jitter: Max. random time in [sec] added to the latency
+        :param response_wait: Time in [sec] the adapter waits for further ECUs
+                              if the request does not state the number of responses,
+                              a request stating it only gets that many frames
+        :param error_rate: Probability of an OBD request failing
+        :param errors: Errors to inject (ERROR_* constants), defaults to all
+        :param pids: Data bytes per Mode 01 PID as function of the time, defaults to DEFAULT_PIDS
+        :param vin: Vehicle Identification Number returned for 0902, None if not supported
+        :param voltage: Battery voltage returned for ATRV
+        :param broadcasts: Data bytes per CAN ID as function of the time, defaults to DEFAULT_BROADCASTS
+        :param monitor_rate: Frames per second sent while monitoring (ATMA)
+        :param buffer_full_rate: Probability of a frame overrunning the adapter's buffer while monitoring
+        :param seed: Seed for latency jitter, error and buffer overrun injection
+        """
+        self._log = logger('ELM327 Emulator')
+        self._protocol = protocol
+        self._latency = latency
+        self._jitter = jitter
+        self._response_wait = response_wait
+        self._error_rate = error_rate
+        self._errors = errors or ALL_ERRORS
+        self._pids = DEFAULT_PIDS if pids is None else pids
+        self._vin = vin
+        self._voltage = voltage
+        self._broadcasts = sorted((DEFAULT_BROADCASTS if broadcasts is None else broadcasts).items())
+        self._monitor_interval = 1 / monitor_rate
+        self._buffer_full_rate = buffer_full_rate
+        self._random = Random(seed)
+
+        self._master = None
+        self._slave = None
+        self._thread: Thread = None
+        self._running = False
+        self._start = monotonic()
+        self._monitoring = False
+        self._next_frame = 0.0
+        self._frame_index = 0
+        self._reset()
+
+    def _reset(self):
+        self._echo = True
+        self._spaces = True
+        self._headers = False
+        # in automatic mode the protocol is only searched for on the first OBD request
+        self._auto = True
+        self._negotiated = False
+
+    @property
+    def path(self) -> str:
+        """
+        Path of the pseudo terminal to connect to
+        """
+        return os.ttyname(self._slave) if self._slave is not None else None
+
+    def start(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self._running = True
+        self._start = monotonic()
+        self._thread = Thread(target=self._serve, name='ELM327 Emulator', daemon=True)
+        self._thread.start()
+        self._log.info("Emulating ELM327 (protocol %s) on %s", self._protocol, self.path)
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def _serve(self):
+        # the slave side is kept open, so reading never fails when a client disconnects
+        pending = b''
+        while self._running:
+            timeout = max(self._next_frame - monotonic(), 0) if self._monitoring else 0.1
+            if not select([self._master], [], [], timeout)[0]:
+                if self._monitoring:
+                    self._write(self._monitor_frame())
+                continue
+            data = os.read(self._master, 1024)
+            if self._monitoring:
+                # any character stops monitoring, it is not taken as part of a command
+                self._monitoring = False
+                self._write('STOPPED\r\r{}'.format(Elm327Emulator.PROMPT).encode())
+                continue
+            pending += data
+            while b'\r' in pending:
+                line, pending = pending.split(b'\r', 1)
+                self._write(self._respond(line.decode('ascii', 'replace')))
+
+    def _write(self, data: bytes):
+        while data:
+            data = data[os.write(self._master, data):]
+
+    def _respond(self, line: str) -> bytes:
+        cmd = line.replace(' ', '').replace('\n', '').upper()
+        if not cmd:
+            return Elm327Emulator.PROMPT.encode()
+
+        echo = line + '\r' if self._echo else ''
+        if cmd == 'ATMA':
+            self._monitoring = True
+            self._next_frame = monotonic()
+            return echo.encode()
+        resp = self._handle_at(cmd) if cmd.startswith('AT') else self._handle_obd(cmd)
+        if isinstance(resp, bytes):
+            return echo.encode() + resp + b'\r\r' + Elm327Emulator.PROMPT.encode()
+        return '{}{}\r\r{}'.format(echo, '\r'.join(resp), Elm327Emulator.PROMPT).encode('ascii')
+
+    def _handle_at(self, cmd: str) -> list:
+        at = cmd[2:]
+        if at in ('Z', 'WS'):
+            self._reset()
+            return ['', 'ELM327 v1.5']
+        if at == 'I':
+            return ['ELM327 v1.5']
+        if at == '@1':
+            return ['OBDII to RS232 Interpreter']
+        if at == 'RV':
+            return ['{:.1f}V'.format(self._voltage)]
+        if at == 'DPN':
+            if not self._negotiated:
+                return ['A0']
+            return [('A' if self._auto else '') + self._protocol]
+        if at.startswith('SP'):
+            self._auto = at[2:] in ('0', '') or at[2:].startswith('A')
+            self._negotiated = not self._auto
+        if at in ('E0', 'E1'):
+            self._echo = at == 'E1'
+        elif at in ('S0', 'S1'):
+            self._spaces = at == 'S1'
+        elif at in ('H0', 'H1'):
+            # only applies to the monitor output
+            self._headers = at == 'H1'
+        elif not at:
+            return ['?']
+        # every other setting (ATSI, ATAT, ATST, ATSH, ATCRA, ...) is accepted and ignored
+        return ['OK']
+
+    def _handle_obd(self, cmd: str) -> list:
+        try:
+            request = bytes.fromhex(cmd[:len(cmd) // 2 * 2])
+        except ValueError:
+            return ['?']
+        # an odd number of digits ends with the number of expected responses
+        counted = len(cmd) % 2 == 1
+        if len(request) < 2:
+            return ['?']
+
+        self._delay(counted)
+        if self._error_rate and self._random.random() < self._error_rate:
+            error = self._random.choice(self._errors)
+            self._negotiated |= error != ERROR_UNABLE_TO_CONNECT
+            if error == ERROR_GARBAGE:
+                return bytes([0xFF] + [self._random.randrange(256) for _ in range(3)])
+            return [error]
+
+        self._negotiated = True
+        mode, pids = request[0], request[1:]
+        if mode == 0x01:
+            payload = self._mode_01(pids)
+            lines = self._format_message(payload) if payload else None
+        elif mode == 0x09 and pids == b'\x02' and self._vin:
+            lines = self._mode_09_vin()
+        else:
+            lines = None
+
+        if not lines:
+            return [ERROR_NO_DATA]
+        if counted:
+            # the adapter stops after the expected number of frames, dropping the rest
+            count = int(cmd[-1], 16)
+            lines = lines[:count + 1] if len(lines) > 1 and len(lines[0]) == 3 else lines[:count]
+        return lines
+
+    def _monitor_frame(self) -> bytes:
+        """
+        Returns the next broadcast frame, ends monitoring with BUFFER FULL on an injected overrun
+        """
+        self._next_frame += self._monitor_interval
+        if self._buffer_full_rate and self._random.random() < self._buffer_full_rate:
+            self._monitoring = False
+            return 'BUFFER FULL\r\r{}'.format(Elm327Emulator.PROMPT).encode()
+
+        can_id, data = self._broadcasts[self._frame_index]
+        self._frame_index = (self._frame_index + 1) % len(self._broadcasts)
+        frame = self._hex(data(monotonic() - self._start))
+        if self._headers:
+            if self._protocol in ('7', '9'):
+                can_id = can_id.rjust(8, '0')
+            frame = can_id + (' ' if self._spaces else '') + frame
+        return (frame + '\r').encode('ascii')
+
+    def _delay(self, counted: bool):
+        delay = self._latency + (self._random.random() * self._jitter if self._jitter else 0)
+        if not counted:
+            delay += self._response_wait
+        if delay > 0:
+            sleep(delay)
+
+    def _mode_01(self, pids: bytes) -> bytes:
+        if len(pids) > 6 or (len(pids) > 1 and self._protocol not in CAN_PROTOCOLS):
+            return None
+
+        t = monotonic() - self._start
+        payload = bytearray([0x41])
+        for pid in pids:
+            if pid % 0x20 == 0:
+                data = self._support_bitmap(pid)
+            else:
+                source = self._pids.get(pid)
+                data = source(t) if source else None
+            if data is not None:
+                payload.append(pid)
+                payload += data
+        return bytes(payload) if len(payload) > 1 else None
+
+    def _support_bitmap(self, base: int) -> bytes:
+        supported = set(self._pids)
+        if base and not any(pid > base for pid in supported):
+            return None
+
+        bitmap = 0
+        for pid in supported:
+            if base < pid <= base + 0x20:
+                bitmap |= 1 << (32 - (pid - base))
+        if any(pid > base + 0x20 for pid in supported):
+            bitmap |= 1  # next bitmap is supported
+        return bitmap.to_bytes(4, 'big')
+
+    def _mode_09_vin(self) -> list:
+        vin = self._vin.encode('ascii')
+        if self._protocol in CAN_PROTOCOLS:
+            return self._format_message(bytes([0x49, 0x02, 0x01]) + vin)
+
+        # ISO 9141 / KWP: one message per 4 bytes, each with a sequence number
+        vin = bytes(20 - len(vin)) + vin
+        return [self._hex(bytes([0x49, 0x02, i // 4 + 1]) + vin[i:i + 4])
+                for i in range(0, len(vin), 4)]
+
+    def _format_message(self, payload: bytes) -> list:
+        if self._protocol not in CAN_PROTOCOLS or len(payload) <= Elm327Emulator.SINGLE_FRAME_BYTES:
+            return [self._hex(payload)]
+
+        lines = ['{:03X}'.format(len(payload))]
+        chunks = [payload[:Elm327Emulator.FIRST_FRAME_BYTES]]
+        for i in range(Elm327Emulator.FIRST_FRAME_BYTES, len(payload), Elm327Emulator.SINGLE_FRAME_BYTES):
+            chunks.append(payload[i:i + Elm327Emulator.SINGLE_FRAME_BYTES])
+        # consecutive frames are padded to their full size
+        chunks[-1] += bytes(Elm327Emulator.SINGLE_FRAME_BYTES - len(chunks[-1]))
+        for i, chunk in enumerate(chunks):
+            lines.append('{:X}:{}'.format(i % 16, self._hex(chunk)))
+        return lines
+
+    def _hex(self, data: bytes) -> str:
+        return (' ' if self._spaces else '').join(['{:02X}'.format(b) for b in data])
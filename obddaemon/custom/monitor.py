@@ -0,0 +1,144 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Framing and decoding of the CAN monitor output of an ELM327 (ATMA) with
+headers on (ATH1) and spaces off (ATS0), e.g. "2011AF8177000000000".
+"""
+from redisdatabus.bus import TypedBusListener
+
+from obddaemon.keys import ALL_KEYS, build_key, key_name
+
+BUFFER_FULL = b'BUFFER FULL'
+PROMPT = b'>'
+
+# length of the CAN ID in hex digits, 11 bit IDs on protocols 6 and 8, 29 bit IDs on 7 and 9
+ID_LENGTHS = {
+    '6': 3,
+    '7': 8,
+    '8': 3,
+    '9': 8
+}
+
+
+class MonitorMapping(object):
+    """
+    Maps a signal within the frames of a CAN ID to a channel:
+    value = int(data bytes [start, start + length), big endian) * scale + offset
+    """
+    __slots__ = ['can_id', 'channel', 'start', 'end', 'scale', 'offset', 'integral']
+
+    def __init__(self, can_id: str, channel: str, start: int, length: int,
+                 scale: float = 1, offset: float = 0):
+        self.can_id = can_id.upper()
+        self.channel = channel
+        # positions within the hex digits of the frame's data
+        self.start = start * 2
+        self.end = (start + length) * 2
+        self.scale = scale
+        self.offset = offset
+        # integer channels get integer values, whatever the scale
+        self.integral = channel.startswith(TypedBusListener.TYPE_PREFIX_INT)
+
+    @staticmethod
+    def parse(name: str, v: str) -> 'MonitorMapping':
+        """
+        Parses a mapping from the configuration
+        :param name: Key name, e.g. "rpm" (see obddaemon.keys)
+        :param v: "<CAN ID>:<first data byte>:<number of bytes>[:<scale>[:<offset>]]", e.g. "201:0:2:0.25"
+        :raises ValueError: if the mapping is invalid
+        """
+        parts = [p.strip() for p in v.split(':')]
+        if not 3 <= len(parts) <= 5:
+            raise ValueError("Invalid monitor mapping {}={}".format(name, v))
+        int(parts[0], 16)
+        return MonitorMapping(parts[0],
+                              channel_for(name),
+                              int(parts[1]),
+                              int(parts[2]),
+                              float(parts[3]) if len(parts) > 3 else 1,
+                              float(parts[4]) if len(parts) > 4 else 0)
+
+
+def channel_for(name: str) -> str:
+    """
+    Returns the channel of the given key name, unknown names become float channels
+    """
+    for key in ALL_KEYS:
+        if key_name(key) == name:
+            return key
+    return build_key(TypedBusListener.TYPE_PREFIX_FLOAT, name)
+
+
+class CanMonitor(object):
+    """
+    Splits the continuous monitor output into frames and decodes the mapped signals
+    """
+
+    def __init__(self, mappings: list, id_length: int = 3):
+        """
+        :param mappings: List of MonitorMapping
+        :param id_length: Length of the CAN ID in hex digits (3 or 8)
+        """
+        self._id_length = id_length
+        self._mappings = {}
+        for m in mappings:
+            can_id = m.can_id.rjust(id_length, '0').encode('ascii')
+            self._mappings.setdefault(can_id, []).append(m)
+        self._pending = b''
+        self.frames = 0
+        self.errors = 0
+        self.buffer_full = 0
+
+    def reset(self):
+        """
+        Drops a partially received line, call this whenever monitoring is (re)started
+        """
+        self._pending = b''
+
+    def feed(self, chunk: bytes) -> (dict, bool):
+        """
+        Decodes the frames within the given monitor output
+        :param chunk: Data received from the adapter
+        :return: Latest value per channel and whether the adapter stopped monitoring
+        """
+        lines = (self._pending + chunk).split(b'\r')
+        self._pending = lines.pop()
+        stopped = PROMPT in self._pending
+        if stopped:
+            self._pending = b''
+
+        values = {}
+        id_length = self._id_length
+        mappings = self._mappings
+        for line in lines:
+            if len(line) <= id_length:
+                if line.strip():
+                    self.errors += 1
+                continue
+            if line == BUFFER_FULL:
+                self.buffer_full += 1
+                continue
+            if b' ' in line or b'<' in line:
+                # messages like "CAN ERROR" or "<RX ERROR", frames contain no spaces (ATS0)
+                self.errors += 1
+                continue
+
+            self.frames += 1
+            signals = mappings.get(line[:id_length])
+            if signals is None:
+                continue
+
+            data = line[id_length:]
+            for m in signals:
+                if m.end > len(data):
+                    continue
+                try:
+                    raw = int(data[m.start:m.end], 16)
+                except ValueError:
+                    self.errors += 1
+                    continue
+                v = raw * m.scale + m.offset
+                values[m.channel] = int(v) if m.integral else v
+        return values, stopped
@@ -0,0 +1,249 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Microbenchmark and golden value checks of the OBD data parser:
+python -m obddaemon.custom.parser_benchmark --baseline parser_baseline.json [--save-baseline]
+python -m obddaemon.custom.parser_benchmark --check-only
+
+Every parser runs over a corpus of realistic responses including error strings.
+Reported are the time per parsed value and the peak memory allocated while
+parsing a single value. The run fails (exit code 1) if a golden value does not
+match, the baseline is missing or a parser got slower than the baseline allows.
+Timings depend on the machine, so the baseline is recorded on the target machine
+with --save-baseline and kept outside the package.
+"""
+import json
+import tracemalloc
+from argparse import ArgumentParser
+from os.path import exists
+from time import perf_counter
+
+from obddaemon.custom.Obd2DataParser import PARSER_MAP, BYTES_PARSER_MAP, \
+    parse_value, parse_obj, parse_response, parse_multi_pid_response
+
+ERROR_RESPONSES = [
+    'NO DATA',
+    'UNABLE TO CONNECT',
+    'SEARCHING...\nUNABLE TO CONNECT',
+    'CAN ERROR',
+    'STOPPED',
+    '?',
+    ''
+]
+
+_O2_SENSOR_RESPONSES = ['80008080', '7FFF8000', '00000000', 'FFFFFFFF', '4A3B80']
+
+VALID_RESPONSES = {
+    'ATRV': ['12.3V', '14.1V', '11.9V', '0.0V'],
+    '0101': ['410100070000', '410183076504', '41017F000000'],
+    '0103': ['41030200', '41030100', '41030400', '410302'],
+    '0104': ['410400', '41047F', '4104FF'],
+    '0105': ['410528', '41057B', '4105FF'],
+    '010B': ['410B1E', '410B65', '410BFF'],
+    '010C': ['410C0000', '410C0C80', '410C1AF8', '410CFFFF'],
+    '010D': ['410D00', '410D3C', '410DFF'],
+    '010F': ['410F00', '410F41', '410FFF'],
+}
+VALID_RESPONSES.update({cmd: ['41' + cmd[2:] + v for v in _O2_SENSOR_RESPONSES]
+                        for cmd in PARSER_MAP if '0134' <= cmd <= '013B'})
+
+# (command, response, expected value)
+GOLDEN_VALUES = [
+    ('ATRV', '12.3V', 12.3),
+    ('ATRV', 'NO DATA', None),
+    ('0101', '410100070000', (False, 0)),
+    ('0101', '410183076504', (True, 3)),
+    ('0101', '41017F000000', (False, 127)),
+    ('0101', 'NO DATA', (None, None)),
+    ('0103', '41030200', (2, 0)),
+    ('0103', '410302', (2, None)),
+    ('0103', 'NO DATA', (None, None)),
+    ('0104', '4104FF', 100.0),
+    ('0104', '410400', 0.0),
+    ('0105', '41057B', 83),
+    ('010B', '410B65', 101),
+    ('010C', '410C1AF8', 1726),
+    ('010C', '410CFFFF', 16383),
+    ('010C', 'NO DATA', None),
+    ('010C', 'UNABLE TO CONNECT', None),
+    ('010D', '410D3C', 60),
+    ('010F', '410F00', -40),
+    ('010F', '410F41', 25),
+    ('0134', '413480008080', (1.0, 0.5)),
+    ('013B', '413B00000000', (0.0, -128.0)),
+    ('0134', '4134', (None, None)),
+]
+
+GOLDEN_FRAMES = [
+    ({'010C': '410C1AF8', '010D': 'UNABLE TO CONNECT', '0199': '419912', 'ATRV': '12.3V'},
+     {'010C': 1726, '010D': None, '0199': None, 'ATRV': 12.3}),
+]
+
+GOLDEN_MULTI_PID = [
+    (['010B', '010C', '010D'], b'410B270C10540D00\r', {'010B': 39, '010C': 1045, '010D': 0}),
+    (['010B', '010C', '010F'], b'00A\r0:410B270C1054\r1:0F410000000000\r',
+     {'010B': 39, '010C': 1045, '010F': 25}),
+    (['010B', '010C'], b'NO DATA\r', {'010B': None, '010C': None}),
+]
+
+
+def corpus(cmd: str) -> list:
+    return VALID_RESPONSES.get(cmd, []) + ERROR_RESPONSES
+
+
+def check_golden_values() -> list:
+    """
+    Compares the parser results with the golden values
+    :return: List of failure descriptions
+    """
+    failures = []
+
+    def check(name, actual, expected):
+        if actual != expected:
+            failures.append("{}: expected {!r}, got {!r}".format(name, expected, actual))
+
+    for cmd, v, expected in GOLDEN_VALUES:
+        check("parse_value({}, {!r})".format(cmd, v), parse_value(cmd, v), expected)
+        if cmd in BYTES_PARSER_MAP:
+            check("parse_response({}, {!r})".format(cmd, v), parse_response(cmd, v.encode()), expected)
+    for frame, expected in GOLDEN_FRAMES:
+        check("parse_obj({!r})".format(frame), parse_obj(frame), expected)
+    for cmds, buf, expected in GOLDEN_MULTI_PID:
+        check("parse_multi_pid_response({!r})".format(buf), parse_multi_pid_response(cmds, buf), expected)
+
+    # the bytes and the string based parser have to agree on the whole corpus
+    for cmd in BYTES_PARSER_MAP:
+        for v in corpus(cmd):
+            check("parse_response({}, {!r})".format(cmd, v), parse_response(cmd, v.encode()),
+                  parse_obj({cmd: v})[cmd])
+    return failures
+
+
+def _benchmarks() -> dict:
+    """
+    Returns the benchmarks as name -> (function, list of argument tuples)
+    """
+    benchmarks = {
+        'parse_value': (parse_value, [(cmd, v) for cmd in PARSER_MAP for v in corpus(cmd)]),
+        'parse_obj': (parse_obj, [({cmd: corpus(cmd)[i % len(corpus(cmd))] for cmd in PARSER_MAP},)
+                                  for i in range(8)]),
+        'parse_response': (parse_response, [(cmd, v.encode()) for cmd in PARSER_MAP for v in corpus(cmd)]),
+        'parse_multi_pid_response': (parse_multi_pid_response, [(cmds, buf) for cmds, buf, _ in GOLDEN_MULTI_PID]),
+    }
+    for cmd, parser in sorted(PARSER_MAP.items()):
+        benchmarks['{} {}'.format(parser.__name__, cmd)] = (parser, [(v,) for v in corpus(cmd)])
+    return benchmarks
+
+
+def _time_per_op(func, args: list, min_time: float) -> float:
+    rounds = 0
+    start = perf_counter()
+    while True:
+        for a in args:
+            func(*a)
+        rounds += 1
+        elapsed = perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / (rounds * len(args))
+
+
+def _alloc_per_op(func, args: list) -> float:
+    total = 0
+    tracemalloc.start()
+    try:
+        for a in args:
+            tracemalloc.clear_traces()
+            func(*a)
+            total += tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return total / len(args)
+
+
+def run_benchmarks(min_time: float = 0.2, repeat: int = 3) -> dict:
+    """
+    Runs all benchmarks
+    :param min_time: Min. time in [sec] per measurement
+    :param repeat: Number of measurements per benchmark, the fastest is taken
+    :return: name -> {'ns_per_op': float, 'alloc_bytes_per_op': float}
+    """
+    results = {}
+    for name, (func, args) in _benchmarks().items():
+        _alloc_per_op(func, args)  # warm up, fills caches like the parser's "reported once" set
+        results[name] = {
+            'ns_per_op': min(_time_per_op(func, args, min_time) for _ in range(repeat)) * 1e9,
+            'alloc_bytes_per_op': _alloc_per_op(func, args)
+        }
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :return: List of benchmarks slower than the baseline allows or missing in it
+    """
+    regressions = []
+    for name, r in sorted(results.items()):
+        b = baseline.get(name)
+        if not b:
+            regressions.append("{}: not in the baseline, record it again with --save-baseline".format(name))
+        elif r['ns_per_op'] > b['ns_per_op'] * (1 + tolerance):
+            regressions.append("{}: {:.0f} ns/op, baseline {:.0f} ns/op".format(
+                name, r['ns_per_op'], b['ns_per_op']))
+    return regressions
+
+
+def format_results(results: dict, baseline: dict) -> str:
+    lines = ["{:<36} {:>10} {:>12} {:>12} {:>8}".format('Benchmark', 'ns/op', 'alloc B/op',
+                                                        'baseline', 'change')]
+    for name, r in sorted(results.items()):
+        b = baseline.get(name)
+        lines.append("{:<36} {:>10.0f} {:>12.0f} {:>12} {:>8}".format(
+            name, r['ns_per_op'], r['alloc_bytes_per_op'],
+            '{:.0f}'.format(b['ns_per_op']) if b else '-',
+            '{:+.1%}'.format(r['ns_per_op'] / b['ns_per_op'] - 1) if b else '-'))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmarks the OBD data parser and checks its golden values')
+    parser.add_argument('--baseline', help='Baseline file (JSON), required unless --check-only is given')
+    parser.add_argument('--save-baseline', action='store_true', help='Stores the results as new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown compared to the baseline, 0.2 = 20 %%')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Min. time in [sec] per measurement')
+    parser.add_argument('--check-only', action='store_true', help='Only checks the golden values')
+    args = parser.parse_args()
+
+    failures = check_golden_values()
+    for f in failures:
+        print("FAIL", f)
+    print("{} golden value checks failed".format(len(failures)) if failures else "Golden values OK")
+    if args.check_only:
+        exit(1 if failures else 0)
+
+    if not args.baseline:
+        parser.error("--baseline is required to compare or save the timings")
+
+    baseline = {}
+    if not args.save_baseline:
+        if not exists(args.baseline):
+            print("FAIL baseline {} not found, record it with --save-baseline".format(args.baseline))
+            exit(1)
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(args.min_time)
+    print(format_results(results, baseline))
+
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print("SLOWER", r)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(args.baseline))
+
+    exit(1 if failures or regressions else 0)
@@ -0,0 +1,122 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Startup benchmark of the daemon modes against the ELM327 emulator:
+python -m obddaemon.custom.startup_benchmark --runs 5
+
+Every run starts a fresh interpreter, measures the time to import the daemon
+of the mode and the time from its startup until the first value is published.
+"""
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser, SUPPRESS
+from statistics import median
+from time import perf_counter, monotonic
+
+from obddaemon.registry import DAEMONS, load_daemon, MODE_OBD
+
+CHILD_TIMEOUT = 60
+
+
+def _child(mode: str, path: str):
+    """
+    Runs in the measured interpreter, prints the results as JSON and exits on the first published value
+    """
+    start = perf_counter()
+    cls = load_daemon(mode)
+    imported = perf_counter() - start
+    result = {
+        'import': imported,
+        'modules': len(sys.modules),
+        'python_obd': 'obd' in sys.modules
+    }
+
+    # imported after measuring, not part of the daemon's startup
+    from obddaemon.custom.benchmark import NullRedis, _build_config
+
+    class StartupProbe(cls):
+        def _build_bus_writer(self, redis=None):
+            return super()._build_bus_writer(redis=NullRedis())
+
+        def _report_first_publish(self):
+            result['first_publish'] = monotonic() - self._started
+            print(json.dumps(result), flush=True)
+            os._exit(0)
+
+    config = _build_config(None, ['OBD.{}={}'.format('Port' if mode == MODE_OBD else 'Path', path),
+                                  'OBD.ConnectionCache=',
+                                  'OBD.StopAfterXEmptyFrames=-1'])
+    daemon = StartupProbe()
+    daemon.set_config(config)
+    daemon.startup()
+
+
+def measure(mode: str, emulator, verbose: bool = False) -> dict:
+    """
+    Starts the daemon of the given mode in a new interpreter connected to the emulator
+    :return: Times in [sec] of the interpreter until the first value has been published ('total'),
+             the import of the daemon ('import') and its startup ('first_publish'), None on failure
+    """
+    start = perf_counter()
+    try:
+        out = subprocess.run([sys.executable, '-m', 'obddaemon.custom.startup_benchmark',
+                              '--child', mode, emulator.path],
+                             stdout=subprocess.PIPE,
+                             stderr=None if verbose else subprocess.DEVNULL,
+                             timeout=CHILD_TIMEOUT).stdout
+    except subprocess.TimeoutExpired:
+        return None
+    total = perf_counter() - start
+    try:
+        result = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        return None
+    result['total'] = total
+    return result
+
+
+def format_results(results: dict) -> str:
+    lines = ["{:<8} {:>5} {:>10} {:>10} {:>10} {:>8} {:>10}".format(
+        'Mode', 'Runs', 'Import ms', 'Start ms', 'Total ms', 'Modules', 'python-obd')]
+    for mode, runs in sorted(results.items()):
+        ok = [r for r in runs if r]
+        if not ok:
+            lines.append("{:<8} {:>5} failed".format(mode, len(runs)))
+            continue
+        lines.append("{:<8} {:>5} {:>10.0f} {:>10.0f} {:>10.0f} {:>8} {:>10}".format(
+            mode, len(ok),
+            median([r['import'] for r in ok]) * 1000,
+            median([r['first_publish'] for r in ok]) * 1000,
+            median([r['total'] for r in ok]) * 1000,
+            ok[0]['modules'],
+            'loaded' if ok[0]['python_obd'] else '-'))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measures import time and time to the first published value per mode')
+    parser.add_argument('--modes', nargs='+', choices=sorted(DAEMONS), default=sorted(DAEMONS))
+    parser.add_argument('--runs', type=int, default=3, help='Runs per mode, the median is reported')
+    parser.add_argument('--latency', type=float, default=0.01, help='Response latency of the emulator in [sec]')
+    parser.add_argument('--verbose', action='store_true', help='Shows the output of the daemons')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'), help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(*args.child)
+        exit(1)  # the daemon ended without publishing a value
+
+    from obddaemon.custom.emulator import Elm327Emulator
+
+    results = {}
+    for mode in args.modes:
+        results[mode] = []
+        for _ in range(args.runs):
+            with Elm327Emulator(latency=args.latency) as emu:
+                results[mode].append(measure(mode, emu, args.verbose))
+    print(format_results(results))
+    exit(0 if all(all(runs) for runs in results.values()) else 1)
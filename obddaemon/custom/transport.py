@@ -0,0 +1,155 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+"""
+import asyncio
+from os import readv
+
+from serial import Serial, SerialException
+
+
+class Elm327Transport(object):
+    """
+    Non-blocking conversation with an ELM327 adapter on the asyncio event loop.
+    The serial port has to be opened with timeout=0, incoming data is read
+    whenever the port becomes readable so waiting for a response never blocks
+    the event loop.
+    Data is read straight into a reusable buffer, responses are handed out as
+    memoryview into that buffer and are only valid until the next command is sent.
+    """
+    PROMPT = b'\r>'
+    BUFFER_SIZE = 1024
+
+    def __init__(self, ser: Serial):
+        self._ser = ser
+        self._buf = bytearray(Elm327Transport.BUFFER_SIZE)
+        self._view = memoryview(self._buf)
+        self._start = 0  # start of unconsumed data
+        self._fill = 0   # end of received data
+        self._stale = False
+
+    def discard_pending(self):
+        """
+        Marks all data received so far as stale, it will be dropped before the next command is sent
+        """
+        self._stale = True
+
+    async def send_and_wait(self, cmd: str, timeout: float) -> memoryview:
+        """
+        Sends a command and waits for the adapter's prompt
+        :param cmd: Command to send (without trailing CR)
+        :param timeout: Max. time in [sec] to wait for the prompt
+        :return: Response without the prompt
+        :raises asyncio.TimeoutError: if no prompt has been received in time
+        """
+        self.send(cmd)
+        try:
+            return await asyncio.wait_for(self._read_until_prompt(), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # a late response must not be taken as the answer to the next command
+            self._stale = True
+            raise
+
+    def send(self, cmd: str):
+        """
+        Sends a command without waiting for the prompt, e.g. to start monitoring (ATMA)
+        :param cmd: Command to send (without trailing CR)
+        """
+        if self._stale:
+            self._ser.reset_input_buffer()
+            self._start = self._fill = 0
+            self._stale = False
+        else:
+            self._compact()
+
+        self._ser.write(str.encode("{}\r".format(cmd)))
+
+    async def read_available(self) -> bytes:
+        """
+        Waits for data and returns everything received since the last call,
+        used to read the continuous output of monitoring commands
+        """
+        while self._fill == self._start:
+            await self._wait_readable()
+        data = bytes(self._view[self._start:self._fill])
+        self._start = self._fill = 0
+        return data
+
+    async def _wait_readable(self):
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+
+        def on_readable():
+            if done.done():
+                return
+            try:
+                self._read_available()
+            except (OSError, SerialException) as e:
+                done.set_exception(e)
+                return
+            done.set_result(None)
+
+        fd = self._ser.fileno()
+        loop.add_reader(fd, on_readable)
+        try:
+            await done
+        finally:
+            loop.remove_reader(fd)
+
+    def _compact(self):
+        # same sized slice assignment, never resizes the buffer while views are exported
+        n = self._fill - self._start
+        if self._start:
+            self._buf[0:n] = self._buf[self._start:self._fill]
+        self._start = 0
+        self._fill = n
+
+    def _grow(self):
+        buf = bytearray(len(self._buf) * 2)
+        buf[0:self._fill] = self._buf[0:self._fill]
+        self._buf = buf
+        self._view = memoryview(buf)
+
+    def _read_available(self):
+        if self._fill == len(self._buf):
+            self._grow()
+        try:
+            n = readv(self._ser.fileno(), [self._view[self._fill:]])
+        except BlockingIOError:
+            return
+        if not n:
+            raise SerialException('device reports readiness to read but returned no data '
+                                  '(device disconnected or multiple access on port?)')
+        self._fill += n
+
+    async def _read_until_prompt(self) -> memoryview:
+        loop = asyncio.get_event_loop()
+        readable = asyncio.Event()
+        error = []
+
+        def on_readable():
+            try:
+                self._read_available()
+            except (OSError, SerialException) as e:
+                error.append(e)
+            readable.set()
+
+        fd = self._ser.fileno()
+        loop.add_reader(fd, on_readable)
+        try:
+            searched = self._start
+            while True:
+                i = self._buf.find(Elm327Transport.PROMPT, searched, self._fill)
+                if i >= 0:
+                    resp = self._view[self._start:i]
+                    self._start = i + len(Elm327Transport.PROMPT)
+                    return resp
+                if error:
+                    raise error[0]
+
+                searched = max(self._fill - len(Elm327Transport.PROMPT) + 1, self._start)
+                readable.clear()
+                await readable.wait()
+        finally:
+            loop.remove_reader(fd)
@@ -3,21 +3,30 @@ CARPI OBD II DAEMON
 (C) 2018, Raphael "rGunti" Guntersweiler
 Licensed under MIT
 """
-from logging import Logger
-from time import sleep
+from time import sleep, monotonic
 
 from carpicommons.log import logger
-from daemoncommons.daemon import Daemon
 from obd import OBD, Async, commands, OBDResponse, Unit
 from obd.codes import FUEL_STATUS
-from redisdatabus.bus import BusWriter
+from serial import SerialException
 
+from obddaemon.base import ObdBaseDaemon
+from obddaemon.connection import ConnectionCache, CachedOBD, CachedAsync, supported_names
 from obddaemon.errors import ObdConnectionError
 from obddaemon.keys import KEY_FUEL_STATUS, KEY_VOLTAGE, KEY_RPM
+from obddaemon.metrics import STAGE_SEND, COUNTER_EMPTY
 from . import keys
 
 
-class ObdDaemon(Daemon):
+def _baudrate(obd_inst: OBD) -> int:
+    """
+    Returns the baudrate python-obd has connected with (not exposed by its API), None if unknown
+    """
+    port = getattr(obd_inst.interface, '_ELM327__port', None)
+    return port.baudrate if port else None
+
+
+class ObdDaemon(ObdBaseDaemon):
     CHECK_DATA_CONNECTION_ON_CHANNELS = [
         KEY_VOLTAGE,
         KEY_RPM
@@ -25,19 +34,12 @@ class ObdDaemon(Daemon):
 
     def __init__(self):
         super().__init__("OBD II Daemon")
-        self._log: Logger = None
         self._obd: OBD = None
-        self._bus: BusWriter = None
         self._running = False
         self._missing_data_counter = 0
         self._throw_after_empty_frames = -1
-
-    def _build_bus_writer(self) -> BusWriter:
-        self._log.info("Connecting to Redis instance ...")
-        return BusWriter(host=self._get_config('Redis', 'Host', '127.0.0.1'),
-                         port=self._get_config_int('Redis', 'Port', 6379),
-                         db=self._get_config_int('Redis', 'DB', 0),
-                         password=self._get_config('Redis', 'Password', None))
+        # port, baudrate, protocol and supported commands of the last successful connection
+        self._cache: ConnectionCache = None
 
     def startup(self):
 
@@ -46,29 +48,45 @@ class ObdDaemon(Daemon):
 
         retries = 5
 
-        self._bus = self._build_bus_writer()
-        cmds = [
-            #(commands.ELM_VOLTAGE, self._create_callback(keys.KEY_VOLTAGE)),
-            (commands.FUEL_STATUS, self._create_callback(keys.KEY_FUEL_STATUS)),
-            (commands.COOLANT_TEMP, self._create_callback(keys.KEY_COOLANT_TEMP)),
-            (commands.INTAKE_PRESSURE, self._create_callback(keys.KEY_INTAKE_PRESSURE)),
-            (commands.RPM, self._create_callback(keys.KEY_RPM)),
-            (commands.SPEED, self._create_callback(keys.KEY_SPEED)),
-            (commands.INTAKE_TEMP, self._create_callback(keys.KEY_INTAKE_TEMP))
-        ]
+        self._setup_bus()
+        cmds = {
+            #keys.KEY_VOLTAGE: (commands.ELM_VOLTAGE, self._create_callback(keys.KEY_VOLTAGE)),
+            keys.KEY_FUEL_STATUS: (commands.FUEL_STATUS, self._create_callback(keys.KEY_FUEL_STATUS)),
+            keys.KEY_COOLANT_TEMP: (commands.COOLANT_TEMP, self._create_callback(keys.KEY_COOLANT_TEMP)),
+            keys.KEY_INTAKE_PRESSURE: (commands.INTAKE_PRESSURE, self._create_callback(keys.KEY_INTAKE_PRESSURE)),
+            keys.KEY_RPM: (commands.RPM, self._create_callback(keys.KEY_RPM)),
+            keys.KEY_SPEED: (commands.SPEED, self._create_callback(keys.KEY_SPEED)),
+            keys.KEY_INTAKE_TEMP: (commands.INTAKE_TEMP, self._create_callback(keys.KEY_INTAKE_TEMP))
+        }
 
         use_async = self._get_config_bool('OBD', 'Async', False)
         self._throw_after_empty_frames = self._get_config_int('OBD', 'StopAfterXEmptyFrames', -1)
 
+        self._cache = ConnectionCache(self._get_config('OBD', 'ConnectionCache', None))
+        configured_port = self._get_config('OBD', 'Port', None)
+        if self._cache.connection and configured_port and self._cache.connection[0] != configured_port:
+            log.info("Ignoring cached connection to %s, %s is configured",
+                     self._cache.connection[0], configured_port)
+            self._cache.clear()
+
+        attempt = 0
         while retries > 0:
             log.info("Connecting to OBD II interface ...")
 
             port = self._get_config('OBD', 'Port', None)
             baudrate = self._get_config_int('OBD', 'Baudrate', None)
+            protocol = None
+            supported = None
             fast_init = self._get_config_bool('OBD', 'FastInit', True)
             timeout = self._get_config_float('OBD', 'Timeout', 1)
 
-            if port:
+            connection = self._cache.connection
+            if connection:
+                # skips the port scan, the baudrate and protocol detection and the supported PIDs queries
+                port, baudrate, protocol = connection
+                supported = self._cache.commands
+                log.info("Connecting to %s (%s baud) using protocol %s as before ...", port, baudrate, protocol)
+            elif port:
                 log.debug("Connecting to %s", port)
             else:
                 log.debug("Using Autodetect to find OBD device")
@@ -77,39 +95,71 @@ class ObdDaemon(Daemon):
                 log.debug("Using Async instance")
                 log.warning("Async can DOS your car! Use it at your own risk!")
                 log.warning("OBD.StopAfterXEmptyFrames is not supported under Async mode.")
-                self._obd = obd_inst = Async(portstr=port,
-                                             baudrate=baudrate,
-                                             fast=fast_init,
-                                             timeout=timeout)
+                self._obd = obd_inst = CachedAsync(portstr=port,
+                                                   baudrate=baudrate,
+                                                   protocol=protocol,
+                                                   fast=fast_init,
+                                                   timeout=timeout,
+                                                   supported=supported)
             else:
                 log.debug("Using manual instance")
-                self._obd = obd_inst = OBD(portstr=port,
-                                           baudrate=baudrate,
-                                           fast=fast_init,
-                                           timeout=timeout)
+                self._obd = obd_inst = CachedOBD(portstr=port,
+                                                 baudrate=baudrate,
+                                                 protocol=protocol,
+                                                 fast=fast_init,
+                                                 timeout=timeout,
+                                                 supported=supported)
 
             if obd_inst.is_connected():
                 log.debug("Connected via %s using %s",
                           obd_inst.port_name(),
                           obd_inst.protocol_name())
+                self._cache.put((obd_inst.port_name(), _baudrate(obd_inst), obd_inst.protocol_id()),
+                                supported_names(obd_inst))
+                retries = 5
+                attempt = 0
                 log.info("Setting up data fetcher ...")
                 if use_async:
-                    for cmd in cmds:
+                    log.warning("PollRates are not supported under Async mode.")
+                    for cmd in cmds.values():
                         log.debug("Watching for %s", cmd[0])
                         obd_inst.watch(cmd[0], callback=cmd[1])
 
                     obd_inst.start()
                     log.info("Started watching")
+                else:
+                    self._scheduler = self._build_scheduler({c: c for c in cmds})
 
                 self._running = True
                 log.info("Entering main loop...")
-                while self._running:
-                    if not use_async:
-                        for cmd in cmds:
+                try:
+                    while self._running:
+                        if use_async:
+                            # values are published by the watcher thread as they arrive
+                            sleep(self._flush_check_interval())
+                            self._flush_bus_if_due()
+                            self._housekeeping()
+                            continue
+
+                        for channel in self._scheduler.wait():
+                            cmd = cmds[channel]
+                            start = monotonic()
                             a = obd_inst.query(cmd[0])
+                            if self._metrics:
+                                self._metrics.observe(STAGE_SEND, cmd[0].name, monotonic() - start)
+                                if a.is_null():
+                                    self._metrics.increment(COUNTER_EMPTY, cmd[0].name)
                             cmd[1](a)
-                    sleep(1)
+                            self._scheduler.mark_polled(channel)
+                        self._flush_bus()
+                        self._housekeeping()
+                except SerialException as e:
+                    log.error("Serial connection error: %s", e)
+                    self._close()
             else:
+                if connection:
+                    log.warning("Failed to connect as before, detecting the interface again")
+                    self._cache.clear()
                 log.warning("Failed to connect to OBD II interface, retrying %s more times ...", retries)
                 retries -= 1
                 if retries <= 0:
@@ -119,7 +169,8 @@ class ObdDaemon(Daemon):
                               "If you use auto-config, try specifying the device in the configuration file.")
                     raise ObdConnectionError(ObdConnectionError.REASON_NO_DEVICE)
 
-            sleep(5)
+            sleep(self._reconnect_delay(attempt))
+            attempt += 1
 
         self._log.info("The OBD II daemon is shutting down ...")
 
@@ -144,7 +195,7 @@ class ObdDaemon(Daemon):
             self._do_missing_value_check(value.value)
 
         self._log.debug("%s: %s (%s)", channel, v, value.value)
-        self._bus.publish(channel, str(v))
+        self._publish(channel, v)
 
     def _do_missing_value_check(self, val):
         if val is None:
@@ -160,6 +211,13 @@ class ObdDaemon(Daemon):
             self._missing_data_counter = 0
             return False
 
+    def _close(self):
+        try:
+            self._obd.close()
+        except SerialException:
+            # closing resets the adapter, which fails on a broken connection
+            pass
+
     def shutdown(self):
         if self._log:
             self._log.info("Shutting down %s ...", self.name)
@@ -169,6 +227,6 @@ class ObdDaemon(Daemon):
             if self._log:
                 self._log.info("Terminating OBD II connection ...")
 
-            if self._obd is Async:
+            if isinstance(self._obd, Async):
                 self._obd.stop()
             self._obd.close()
@@ -0,0 +1,171 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Values derived from the published ones, computed once in the daemon
+instead of in every subscriber:
+- mass air flow, estimated by speed-density from RPM, intake pressure and temperature
+- fuel rate and fuel economy, from the mass air flow and the speed
+- overall gear ratio (engine to wheel revolutions), from RPM and speed
+- trip distance, the integrated speed
+"""
+from time import monotonic
+
+from obddaemon.keys import KEY_RPM, KEY_SPEED, KEY_INTAKE_PRESSURE, KEY_INTAKE_TEMP, \
+    KEY_MAF, KEY_FUEL_RATE, KEY_FUEL_ECONOMY, KEY_GEAR_RATIO, KEY_TRIP_DISTANCE
+
+AIR_MOLAR_MASS = 28.97  # g/mol
+GAS_CONSTANT = 8.314    # J/(mol K)
+
+
+class VehicleParameters(object):
+    """
+    Vehicle specific constants of the derivations
+    """
+
+    def __init__(self,
+                 displacement: float = 1.6,
+                 volumetric_efficiency: float = 0.85,
+                 air_fuel_ratio: float = 14.7,
+                 fuel_density: float = 745,
+                 tire_circumference: float = 1.95,
+                 final_drive: float = 1.0,
+                 min_speed: float = 5):
+        """
+        :param displacement: Engine displacement in [l]
+        :param volumetric_efficiency: Ratio of the air actually filling the cylinders
+        :param air_fuel_ratio: Stoichiometric air fuel ratio by mass, 14.7 for gasoline
+        :param fuel_density: Fuel density in [g/l], 745 for gasoline
+        :param tire_circumference: Rolling circumference of the driven wheels in [m]
+        :param final_drive: Final drive ratio, 1 to get the overall ratio instead of the gearbox ratio
+        :param min_speed: Min. speed in [km/h] for fuel economy and gear ratio
+        """
+        self.displacement = displacement
+        self.volumetric_efficiency = volumetric_efficiency
+        self.air_fuel_ratio = air_fuel_ratio
+        self.fuel_density = fuel_density
+        self.tire_circumference = tire_circumference
+        self.final_drive = final_drive
+        self.min_speed = min_speed
+
+
+class Derivation(object):
+    """
+    A derived channel computed from input channels, the function gets the input values
+    in the given order and returns None if the value is undefined
+    """
+    __slots__ = ['channel', 'inputs', 'func']
+
+    def __init__(self, channel: str, inputs: list, func):
+        self.channel = channel
+        self.inputs = inputs
+        self.func = func
+
+
+class TripDistance(object):
+    """
+    Integrates the speed over the time of the samples, the speed being constant between two samples
+    """
+
+    def __init__(self):
+        self._speed = None
+        self._time = 0.0
+        self.distance = 0.0
+
+    def __call__(self, speed: float, t: float = None) -> float:
+        """
+        :param speed: Speed in [km/h]
+        :param t: Time of the sample in [sec], e.g. the position of a replay, defaults to the current time
+        """
+        now = monotonic() if t is None else t
+        # a restarted replay starts over at an earlier time
+        if self._speed is not None and now >= self._time:
+            self.distance += self._speed * (now - self._time) / 3600
+        self._speed = speed
+        self._time = now
+        return round(self.distance, 3)
+
+
+def build_derivations(p: VehicleParameters) -> list:
+    """
+    Returns the derivations of the given vehicle, every derivation after the ones it depends on
+    """
+    # air mass per second = pressure * volume per second / (R * T) * molar mass,
+    # a four stroke engine taking in its displacement every second revolution
+    maf_factor = p.displacement / 120 * p.volumetric_efficiency * AIR_MOLAR_MASS / GAS_CONSTANT
+    fuel_factor = 3600 / p.air_fuel_ratio / p.fuel_density
+    # engine revolutions per wheel revolution = rpm / (speed [m/min] / circumference)
+    ratio_factor = p.tire_circumference * 60 / 1000 / p.final_drive
+    min_speed = p.min_speed
+
+    def maf(rpm, pressure, temperature):
+        return round(pressure * rpm * maf_factor / (temperature + 273.15), 2)
+
+    def fuel_rate(maf):
+        return round(maf * fuel_factor, 2)
+
+    def fuel_economy(fuel_rate, speed):
+        return round(fuel_rate * 100 / speed, 1) if speed >= min_speed else None
+
+    def gear_ratio(rpm, speed):
+        return round(rpm * ratio_factor / speed, 2) if speed >= min_speed else None
+
+    return [
+        Derivation(KEY_MAF, [KEY_RPM, KEY_INTAKE_PRESSURE, KEY_INTAKE_TEMP], maf),
+        Derivation(KEY_FUEL_RATE, [KEY_MAF], fuel_rate),
+        Derivation(KEY_FUEL_ECONOMY, [KEY_FUEL_RATE, KEY_SPEED], fuel_economy),
+        Derivation(KEY_GEAR_RATIO, [KEY_RPM, KEY_SPEED], gear_ratio),
+    ]
+
+
+class DerivedMetrics(object):
+    """
+    Updates the derived values whenever an input changes
+    """
+
+    def __init__(self, derivations: list, trip_distance: bool = True):
+        """
+        :param derivations: Derivations, every one after the ones it depends on
+        :param trip_distance: Integrate the speed to the trip distance
+        """
+        self._values = {}
+        self._dependents = {}
+        for d in derivations:
+            for channel in d.inputs:
+                self._dependents.setdefault(channel, []).append(d)
+        self._trip = TripDistance() if trip_distance else None
+
+    def update(self, channel: str, value, t: float = None) -> list:
+        """
+        Takes a new value of a channel
+        :param t: Time of the sample in [sec], defaults to the current time
+        :return: List of (channel, value) of the derived values which changed
+        """
+        results = []
+        if channel == KEY_SPEED and self._trip:
+            # advances with every sample, not only if the speed changed
+            distance = self._trip(value, t)
+            if distance != self._values.get(KEY_TRIP_DISTANCE):
+                self._values[KEY_TRIP_DISTANCE] = distance
+                results.append((KEY_TRIP_DISTANCE, distance))
+
+        if channel not in self._dependents or self._values.get(channel) == value:
+            return results
+        self._values[channel] = value
+
+        values = self._values
+        changed = [channel]
+        for c in changed:
+            for d in self._dependents.get(c, ()):
+                args = [values.get(i) for i in d.inputs]
+                if None in args:
+                    continue
+                v = d.func(*args)
+                if v == values.get(d.channel):
+                    continue
+                values[d.channel] = v
+                if v is not None:
+                    results.append((d.channel, v))
+                changed.append(d.channel)
+        return results
@@ -3,15 +3,23 @@ CARPI OBD II DAEMON
 (C) 2018, Raphael "rGunti" Guntersweiler
 Licensed under MIT
 """
+from ast import literal_eval
 from time import sleep
-from logging import Logger, DEBUG
+from logging import DEBUG
 from typing import Any
 
-from daemoncommons.daemon import Daemon, DaemonRunner
+from daemoncommons.daemon import DaemonRunner
 from carpicommons.log import logger, DEFAULT_CONFIG
-from obd.codes import FUEL_STATUS
-from redisdatabus.bus import BusWriter
 import obddaemon.keys as keys
+from obddaemon.base import ObdBaseDaemon
+from obddaemon.recording import RecordingReader, is_recording
+from obddaemon.replay import ReplayClock, ReplayLog, parse_speed, parse_time
+
+
+def _fuel_status() -> list:
+    # python-obd (and with it Pint) is only imported once a fuel status entry is read
+    from obd.codes import FUEL_STATUS
+    return FUEL_STATUS
 
 
 class Entry:
@@ -29,6 +37,8 @@ class Entry:
         TYPE_INTAKE_TEMP
     ]
 
+    __slots__ = ['_type', '_value', '_timestamp', '_time_dif']
+
     def __init__(self,
                  type: str,
                  value: str,
@@ -60,23 +70,34 @@ class Entry:
 
     @staticmethod
     def parse_line(line: str):
-        l = line.strip().split('|')
-        timestamp = float(l[0].strip())
+        l = line.split('|', 2)
+        if len(l) < 3:
+            return None
+
         type = l[1].strip()
-        value = l[2].strip()
+        if type not in Entry.ACCEPTED_TYPES:
+            return None
+
+        try:
+            timestamp = float(l[0])
+            value = Entry._parse_value(type, l[2].strip())
+        except ValueError:
+            return None
 
         return Entry(type=type,
-                     value=Entry._parse_value(type, value),
-                     timestamp=timestamp) \
-            if type in Entry.ACCEPTED_TYPES \
-            else None
+                     value=value,
+                     timestamp=timestamp)
 
     @staticmethod
     def _parse_value(v_type: str, value: str) -> Any:
         if v_type == Entry.TYPE_FUEL_STATUS:
-            v = eval(value)  # type: tuple
-            if type(v) is tuple and v[0] in FUEL_STATUS:
-                return FUEL_STATUS.index(v[0])
+            try:
+                v = literal_eval(value)  # type: tuple
+            except (ValueError, SyntaxError):
+                return -1
+            fuel_status = _fuel_status()
+            if type(v) is tuple and v and v[0] in fuel_status:
+                return fuel_status.index(v[0])
             else:
                 return -1
 
@@ -97,26 +118,50 @@ class Entry:
                                              self._value)
 
 
-class ObdDummyDaemon(Daemon):
+def read_entries(file: str):
+    """
+    Reads the entries of a log file one by one, setting the time difference
+    to the previous entry on the fly
+    :param file: Path to the log file (text log or binary recording)
+    :return: Generator of Entry
+    """
+    last_e = None
+    for e in (_read_recording(file) if is_recording(file) else _read_text_log(file)):
+        if last_e:
+            e.time_dif = e.timestamp - last_e.timestamp
+        last_e = e
+        yield e
+
+
+def _read_text_log(file: str):
+    with open(file, 'r') as f:
+        for line in f:
+            e = Entry.parse_line(line)
+            if e:
+                yield e
+
+
+def _read_recording(file: str):
+    for type, timestamp, value in RecordingReader(file).entries():
+        if type in Entry.ACCEPTED_TYPES:
+            yield Entry(type=type,
+                        value=int(value) if value.is_integer() else value,
+                        timestamp=timestamp)
+
+
+class ObdDummyDaemon(ObdBaseDaemon):
     def __init__(self, file: str):
         super().__init__("OBD Dummy Daemon ({})".format(file))
-        self._log: Logger = None
-        self._bus: BusWriter = None
         self._running = False
         self._file = file
-
-    def _build_bus_writer(self) -> BusWriter:
-        self._log.info("Connecting to Redis instance ...")
-        return BusWriter(host=self._get_config('Redis', 'Host', '127.0.0.1'),
-                         port=self._get_config_int('Redis', 'Port', 6379),
-                         db=self._get_config_int('Redis', 'DB', 0),
-                         password=self._get_config('Redis', 'Password', None))
+        self._replay_log = None
+        self._replay_range = None
 
     def startup(self):
         self._log = log = logger(self.name)
         log.info("Starting up %s ...", self.name)
 
-        self._bus = bus = self._build_bus_writer()
+        self._setup_bus()
         entry_mapping = {
             Entry.TYPE_INTAKE_TEMP: keys.KEY_INTAKE_TEMP,
             Entry.TYPE_SPEED: keys.KEY_SPEED,
@@ -125,56 +170,71 @@ class ObdDummyDaemon(Daemon):
             Entry.TYPE_FUEL_STATUS: keys.KEY_FUEL_STATUS
         }
 
-        log.info("Loading file into memory ...")
-        entries = []
-        with open(self._file, 'r') as f:
-            last_e = None
-            for line in f.readlines():
-                e = Entry.parse_line(line)
-                if e:
-                    entries.append(e)
-                    if last_e:
-                        e.time_dif = e.timestamp - last_e.timestamp
-                    log.debug(e)
-                    last_e = e
-
-        e_len = len(entries)
-        e_dur = sum([e.time_dif for e in entries])
-
-        log.info("Loaded %s entries (playback time: about %.3f sec), playing back now ...",
-                 e_len, e_dur)
+        clock = ReplayClock(speed=parse_speed(self._get_config('Replay', 'Speed', '1')),
+                            max_gap=self._get_config_float('Replay', 'MaxGap', 30))
+        log.info("Replaying at %s", "max. speed" if clock.unthrottled else "{}x speed".format(clock.speed))
+        self._load_replay_range()
 
         self._running = True
         while self._running:
             log.info("Playback started")
+            clock.start()
 
             i = 0
-            t = float(0)
             lt = 0
-            for e in entries:
-                self._publish(entry_mapping[e.val_type], str(e.value))
+            for val_type, value, time_dif in self._replay_entries():
+                if time_dif > 0:
+                    self._flush_bus()
+                    self._housekeeping()
 
-                if e.time_dif > 30:
-                    log.warning("Skipped frame sleep %s as it waits too long (%.1f sec), only sleeping 0.1 sec", i, e.time_dif)
-                    sleep(0.1)
-                    t += e.time_dif
-                    continue
-                elif e.time_dif >= 1:
-                    log.debug("Longer time dif detected: Entry %s, sleeps for %.2f sec", i, e.time_dif)
+                if clock.wait(time_dif) < time_dif:
+                    log.warning("Skipped frame sleep %s as it waits too long (%.1f sec)", i, time_dif)
+                elif time_dif >= 1:
+                    log.debug("Longer time dif detected: Entry %s, sleeps for %.2f sec", i, time_dif)
 
-                sleep(e.time_dif)
+                # derived values are integrated over the log time, not over the accelerated replay
+                self._publish(entry_mapping[val_type], value, clock.position)
 
-                t += e.time_dif
                 i += 1
+                t = clock.position
                 if int(t) % 5 == 0 and lt != int(t):
-                    log.debug("Played back %s / %s frames (%.1f / %.1f sec)", i, e_len, t, e_dur)
+                    log.debug("Played back %s frames (%.1f sec)", i, t)
                     lt = int(t)
 
-            log.info("Playback completed, repeating in 5 seconds ...")
+            self._flush_bus()
+            messages, duration, rate, max_lag, avg_lag = clock.report()
+            log.info("Playback of %s frames (%.1f sec) completed in %.1f sec: "
+                     "%.1f messages/sec, lag max. %.1f ms, avg. %.1f ms",
+                     messages, clock.position, duration, rate, max_lag * 1000, avg_lag * 1000)
+            log.info("Repeating in 5 seconds ...")
             sleep(5)
 
-    def _publish(self, channel: str, val: str):
-        self._bus.publish(channel, val)
+    def _load_replay_range(self):
+        """
+        Loads the log into memory if replay should not start at its beginning
+        or only a part of it should be looped ([Replay] StartTime, StartOffset, Duration)
+        """
+        start_time = self._get_config('Replay', 'StartTime', '').strip()
+        start_offset = self._get_config_float('Replay', 'StartOffset', 0)
+        duration = self._get_config_float('Replay', 'Duration', 0)
+        if not start_time and not start_offset and not duration:
+            return
+
+        replay_log = ReplayLog.load((e.val_type, e.timestamp, e.value) for e in read_entries(self._file))
+        start = (parse_time(start_time) if start_time else replay_log.start) + start_offset
+        self._replay_log = replay_log
+        self._replay_range = replay_log.range(start, duration or None)
+        self._log.info("Replaying entries %s to %s of %s (starting at %.1f sec into the log)",
+                       self._replay_range[0], self._replay_range[1], len(replay_log),
+                       start - replay_log.start)
+
+    def _replay_entries(self):
+        """
+        Returns the entries to replay as tuples (type, value, time_dif)
+        """
+        if self._replay_log is not None:
+            return self._replay_log.entries(*self._replay_range)
+        return ((e.val_type, e.value, e.time_dif) for e in read_entries(self._file))
 
     def shutdown(self):
         super().shutdown()
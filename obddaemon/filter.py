@@ -0,0 +1,76 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+"""
+from numbers import Number
+from time import monotonic
+from typing import Any
+
+
+def parse_deadband(v: str) -> (float, bool):
+    """
+    Parses a deadband configuration value
+    :param v: Absolute (e.g. "1.5") or relative (e.g. "5%") deadband
+    :return: Threshold and whether the threshold is relative to the last value
+    """
+    v = v.strip()
+    if v.endswith('%'):
+        return float(v[:-1]) / 100, True
+    else:
+        return float(v), False
+
+
+class PublishFilter(object):
+    """
+    Suppresses values which did not change by more than a deadband compared to the
+    last published value of the same channel. A value is published anyway if the
+    channel has been silent for longer than the heartbeat interval.
+    """
+
+    def __init__(self, deadbands: dict, heartbeat: float = 10):
+        """
+        :param deadbands: Deadband per channel as returned by parse_deadband,
+                          channels without deadband are published on every change
+        :param heartbeat: Max. time in [sec] a channel stays silent, <= 0 disables the heartbeat
+        """
+        self._deadbands = deadbands
+        self._heartbeat = heartbeat
+        self._last = {}
+        self._passed = {}
+        self._suppressed = {}
+
+    def accept(self, channel: str, value: Any, now: float = None) -> bool:
+        """
+        Returns True if the given value should be published
+        """
+        if now is None:
+            now = monotonic()
+
+        last = self._last.get(channel)
+        if last is None \
+                or 0 < self._heartbeat <= now - last[1] \
+                or self._changed(channel, last[0], value):
+            self._last[channel] = (value, now)
+            self._passed[channel] = self._passed.get(channel, 0) + 1
+            return True
+        else:
+            self._suppressed[channel] = self._suppressed.get(channel, 0) + 1
+            return False
+
+    def _changed(self, channel: str, last: Any, value: Any) -> bool:
+        if not isinstance(value, Number) or not isinstance(last, Number) \
+                or isinstance(value, bool):
+            return value != last
+
+        threshold, relative = self._deadbands.get(channel, (0, False))
+        if relative:
+            threshold *= abs(last)
+        return abs(value - last) > threshold
+
+    def counters(self) -> dict:
+        """
+        Returns the number of published and suppressed values per channel
+        """
+        return {c: (self._passed.get(c, 0), self._suppressed.get(c, 0))
+                for c in set(self._passed) | set(self._suppressed)}
@@ -3,9 +3,14 @@ CARPI OBD II DAEMON
 (C) 2018, Raphael "rGunti" Guntersweiler
 Licensed under MIT
 """
+from os import environ
+
 from redisdatabus.bus import TypedBusListener
 
-KEY_BASE = 'carpi.obd.'
+# overrides the key base of a process, set by the supervisor for every adapter worker
+ENV_KEY_BASE = 'OBD_KEY_BASE'
+
+KEY_BASE = environ.get(ENV_KEY_BASE, 'carpi.obd.')
 
 
 def build_key(type, name):
@@ -13,6 +18,14 @@ def build_key(type, name):
     return "{}{}{}".format(type, KEY_BASE, name)
 
 
+def key_name(key):
+    """
+    Returns the name part of a key built by build_key (e.g. "rpm" for "i#carpi.obd.rpm")
+    """
+    global KEY_BASE
+    return key[key.index(KEY_BASE) + len(KEY_BASE):]
+
+
 KEY_VOLTAGE = build_key(TypedBusListener.TYPE_PREFIX_FLOAT, "voltage")
 KEY_FUEL_STATUS = build_key(TypedBusListener.TYPE_PREFIX_INT, "fuel_status")
 KEY_COOLANT_TEMP = build_key(TypedBusListener.TYPE_PREFIX_INT, "coolant_temp")
@@ -21,6 +34,17 @@ KEY_RPM = build_key(TypedBusListener.TYPE_PREFIX_INT, "rpm")
 KEY_SPEED = build_key(TypedBusListener.TYPE_PREFIX_INT, "speed")
 KEY_INTAKE_TEMP = build_key(TypedBusListener.TYPE_PREFIX_INT, "temperature")
 
+# derived from the values above (see obddaemon.derived)
+KEY_MAF = build_key(TypedBusListener.TYPE_PREFIX_FLOAT, "maf")                          # g/s
+KEY_FUEL_RATE = build_key(TypedBusListener.TYPE_PREFIX_FLOAT, "fuel_rate")              # l/h
+KEY_FUEL_ECONOMY = build_key(TypedBusListener.TYPE_PREFIX_FLOAT, "fuel_economy")        # l/100 km
+KEY_GEAR_RATIO = build_key(TypedBusListener.TYPE_PREFIX_FLOAT, "gear_ratio")
+KEY_TRIP_DISTANCE = build_key(TypedBusListener.TYPE_PREFIX_FLOAT, "trip_distance")      # km
+
+# plain Redis key holding the daemon's metrics (JSON)
+KEY_METRICS = "{}metrics".format(KEY_BASE)
+# Redis Stream holding the history of the published values, one entry per frame (see obddaemon.bus.StreamBusWriter)
+KEY_STREAM = "{}stream".format(KEY_BASE)
 
 ALL_KEYS = [
     KEY_VOLTAGE,
@@ -31,3 +55,14 @@ ALL_KEYS = [
     KEY_SPEED,
     KEY_INTAKE_TEMP
 ]
+
+DERIVED_KEYS = [
+    KEY_MAF,
+    KEY_FUEL_RATE,
+    KEY_FUEL_ECONOMY,
+    KEY_GEAR_RATIO,
+    KEY_TRIP_DISTANCE
+]
+
+# everything the daemon publishes, the raw values along with the ones derived from them
+PUBLISHED_KEYS = ALL_KEYS + DERIVED_KEYS
@@ -0,0 +1,136 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+"""
+from bisect import bisect_left
+from collections import Counter
+from threading import Lock
+from time import monotonic
+
+STAGE_SEND = 'send'        # command sent until the prompt has been received
+STAGE_DECODE = 'decode'    # response parsed
+STAGE_PUBLISH = 'publish'  # value handed to the bus writer
+STAGE_FLUSH = 'flush'      # collected values sent to Redis
+STAGE_STARTUP = 'startup'  # daemon started until the first value has been published
+
+COUNTER_TIMEOUT = 'timeout'
+COUNTER_EMPTY = 'empty'    # empty or invalid (0xFF) response
+COUNTER_PARSE_FAILURE = 'parse_failure'
+COUNTER_BUFFER_FULL = 'buffer_full'  # adapter buffer overrun while monitoring
+COUNTER_MONITOR_FRAMES = 'monitor_frames'
+COUNTER_MONITOR_ERRORS = 'monitor_errors'
+
+
+class Histogram(object):
+    """
+    Histogram with logarithmic buckets, every bucket's upper bound being
+    twice the previous one (1 us, 2 us, 4 us, ... 67 sec)
+    """
+    BOUNDS = [1e-6 * 2 ** i for i in range(27)]
+
+    def __init__(self):
+        self._buckets = [0] * (len(Histogram.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, v: float):
+        self._buckets[bisect_left(Histogram.BOUNDS, v)] += 1
+        self.count += 1
+        self.sum += v
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket holding the given quantile
+        :param q: Quantile from 0 - 1
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self._buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(Histogram.BOUNDS[i], self.max) if i < len(Histogram.BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            # non-empty buckets only: upper bound -> count
+            'buckets': {'{:g}'.format(Histogram.BOUNDS[i]) if i < len(Histogram.BOUNDS) else 'inf': n
+                        for i, n in enumerate(self._buckets) if n}
+        }
+
+
+class Metrics(object):
+    """
+    Latency histograms per stage and command plus event counters,
+    safe to be used from the polling and the publishing thread
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms = {}
+        self._counters = Counter()
+        self._started = monotonic()
+
+    def observe(self, stage: str, name: str, seconds: float):
+        """
+        Records the duration of a stage (STAGE_*) for a command or channel
+        """
+        with self._lock:
+            h = self._histograms.get((stage, name))
+            if h is None:
+                h = self._histograms[(stage, name)] = Histogram()
+            h.observe(seconds)
+
+    def increment(self, counter: str, name: str, n: int = 1):
+        """
+        Counts an event (COUNTER_*) for a command
+        """
+        with self._lock:
+            self._counters[(counter, name)] += n
+
+    def snapshot(self) -> dict:
+        """
+        Returns all metrics as dictionary (JSON serializable)
+        """
+        with self._lock:
+            histograms = {}
+            for (stage, name), h in self._histograms.items():
+                histograms.setdefault(stage, {})[name] = h.to_dict()
+            counters = {}
+            for (counter, name), n in self._counters.items():
+                counters.setdefault(counter, {})[name] = n
+        return {
+            'uptime': monotonic() - self._started,
+            'latency': histograms,
+            'counters': counters
+        }
+
+    def dump(self) -> str:
+        """
+        Returns all metrics as plain text table
+        """
+        snapshot = self.snapshot()
+        lines = ["Uptime {:.0f} sec".format(snapshot['uptime']),
+                 "{:<8} {:<20} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+                     'Stage', 'Name', 'Count', 'Avg ms', 'P50 ms', 'P95 ms', 'P99 ms', 'Max ms')]
+        for stage, names in sorted(snapshot['latency'].items()):
+            for name, h in sorted(names.items()):
+                lines.append("{:<8} {:<20} {:>8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+                    stage, name, h['count'], h['sum'] / h['count'] * 1000,
+                    h['p50'] * 1000, h['p95'] * 1000, h['p99'] * 1000, h['max'] * 1000))
+        for counter, names in sorted(snapshot['counters'].items()):
+            for name, n in sorted(names.items()):
+                lines.append("{:<14} {:<20} {:>8}".format(counter, name, n))
+        return '\n'.join(lines)
@@ -0,0 +1,227 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Compact binary recording format
+
+A recording starts with a header (magic, version, compression) followed by
+chunks. Every chunk holds up to chunk_size entries stored column wise: for
+every channel the timestamps and the values as float64 arrays. The payload
+of a chunk can be compressed with zlib or lzma.
+
+  header:  6s magic | B version | B compression
+  chunk:   I number of entries | I payload length | payload
+  payload: per channel: B name length | name | I n | n * d timestamps | n * d values
+"""
+import lzma
+import zlib
+from array import array
+from heapq import merge
+from struct import Struct
+from sys import byteorder
+
+MAGIC = b'OBDREC'
+VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+
+COMPRESSION_NAMES = {
+    'none': COMPRESSION_NONE,
+    'zlib': COMPRESSION_ZLIB,
+    'lzma': COMPRESSION_LZMA
+}
+
+DEFAULT_CHUNK_SIZE = 4096
+
+_HEADER = Struct('<6sBB')
+_CHUNK_HEADER = Struct('<II')
+_COUNT = Struct('<I')
+
+_COMPRESS = {
+    COMPRESSION_NONE: lambda b: b,
+    COMPRESSION_ZLIB: zlib.compress,
+    COMPRESSION_LZMA: lzma.compress
+}
+
+_DECOMPRESS = {
+    COMPRESSION_NONE: lambda b: b,
+    COMPRESSION_ZLIB: zlib.decompress,
+    COMPRESSION_LZMA: lzma.decompress
+}
+
+
+class RecordingFormatError(Exception):
+    pass
+
+
+def is_recording(file: str) -> bool:
+    """
+    Returns True if the given file is a binary recording
+    """
+    with open(file, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _to_le(a: array) -> bytes:
+    if byteorder == 'big':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _from_le(b, n: int) -> array:
+    a = array('d')
+    a.frombytes(b[:n * a.itemsize])
+    if byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+class RecordingWriter(object):
+    def __init__(self,
+                 file: str,
+                 compression: int = COMPRESSION_ZLIB,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        :param file: Path of the recording to write
+        :param compression: One of the COMPRESSION_* constants
+        :param chunk_size: Number of entries per chunk
+        """
+        if compression not in _COMPRESS:
+            raise RecordingFormatError("Unknown compression {}".format(compression))
+
+        self._f = open(file, 'wb')
+        self._compression = compression
+        self._chunk_size = chunk_size
+        self._columns = {}
+        self._count = 0
+        self._f.write(_HEADER.pack(MAGIC, VERSION, compression))
+
+    def add(self, channel: str, timestamp: float, value: float):
+        column = self._columns.get(channel)
+        if column is None:
+            self._columns[channel] = column = (array('d'), array('d'))
+        column[0].append(timestamp)
+        column[1].append(value)
+
+        self._count += 1
+        if self._count >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all pending entries as a chunk
+        """
+        if not self._count:
+            return
+
+        payload = bytearray()
+        for channel, (timestamps, values) in self._columns.items():
+            name = channel.encode('utf-8')
+            payload += bytes([len(name)]) + name + _COUNT.pack(len(timestamps))
+            payload += _to_le(timestamps)
+            payload += _to_le(values)
+
+        payload = _COMPRESS[self._compression](bytes(payload))
+        self._f.write(_CHUNK_HEADER.pack(self._count, len(payload)))
+        self._f.write(payload)
+        self._columns = {}
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RecordingReader(object):
+    def __init__(self, file: str):
+        """
+        :param file: Path of the recording to read
+        """
+        self._file = file
+
+    def chunks(self):
+        """
+        Reads the recording chunk by chunk
+        :return: Generator of dict with a tuple of timestamps and values (both array of float) per channel
+        """
+        with open(self._file, 'rb') as f:
+            magic, version, compression = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC or version != VERSION or compression not in _DECOMPRESS:
+                raise RecordingFormatError("{} is not a supported recording".format(self._file))
+
+            while True:
+                header = f.read(_CHUNK_HEADER.size)
+                if len(header) < _CHUNK_HEADER.size:
+                    return
+                _, size = _CHUNK_HEADER.unpack(header)
+                yield self._parse_chunk(_DECOMPRESS[compression](f.read(size)))
+
+    @staticmethod
+    def _parse_chunk(payload: bytes) -> dict:
+        columns = {}
+        view = memoryview(payload)
+        i = 0
+        while i < len(payload):
+            name_len = payload[i]
+            channel = bytes(view[i + 1:i + 1 + name_len]).decode('utf-8')
+            i += 1 + name_len
+            n, = _COUNT.unpack_from(payload, i)
+            i += _COUNT.size
+            timestamps = _from_le(view[i:], n)
+            i += n * timestamps.itemsize
+            values = _from_le(view[i:], n)
+            i += n * values.itemsize
+            columns[channel] = (timestamps, values)
+        return columns
+
+    def entries(self):
+        """
+        Reads all entries in order of their timestamps
+        :return: Generator of tuples (channel, timestamp, value)
+        """
+        for columns in self.chunks():
+            streams = [zip(timestamps, [channel] * len(timestamps), values)
+                       for channel, (timestamps, values) in columns.items()]
+            for timestamp, channel, value in merge(*streams):
+                yield channel, timestamp, value
+
+
+def convert_text_log(src: str, dst: str,
+                     compression: int = COMPRESSION_ZLIB,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Converts a text log (see dummy.txt) into a binary recording
+    :return: Number of converted entries
+    """
+    from obddaemon.dummy import read_entries
+
+    n = 0
+    with RecordingWriter(dst, compression, chunk_size) as w:
+        for e in read_entries(src):
+            w.add(e.val_type, e.timestamp, e.value)
+            n += 1
+    return n
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Converts a text log into a binary recording')
+    parser.add_argument('src', help='Text log to convert')
+    parser.add_argument('dst', help='Recording to write')
+    parser.add_argument('--compression', choices=sorted(COMPRESSION_NAMES), default='zlib')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    count = convert_text_log(args.src, args.dst, COMPRESSION_NAMES[args.compression], args.chunk_size)
+    print("Converted {} entries".format(count))
@@ -0,0 +1,26 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Daemon classes per mode, a daemon's module (and with it e.g. python-obd and Pint)
+is only imported when its mode has been selected.
+"""
+from importlib import import_module
+
+MODE_OBD = 'obd'        # python-obd based daemon
+MODE_SERIAL = 'serial'  # own ELM327 implementation
+
+DAEMONS = {
+    MODE_OBD: 'obddaemon.daemon:ObdDaemon',
+    MODE_SERIAL: 'obddaemon.custom.daemon:SerialObdDaemon'
+}
+
+
+def load_daemon(mode: str) -> type:
+    """
+    Imports and returns the daemon class of the given mode
+    :raises KeyError: if the mode is unknown
+    """
+    module, name = DAEMONS[mode].split(':')
+    return getattr(import_module(module), name)
@@ -0,0 +1,210 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+"""
+from array import array
+from bisect import bisect_left
+from datetime import datetime
+from time import monotonic, sleep
+
+SPEED_MAX = 'max'
+
+
+def parse_speed(v: str) -> float:
+    """
+    Parses a replay speed, "max" (or any value <= 0) meaning unthrottled
+    :param v: e.g. "1", "10", "max"
+    :return: Speed multiplier, 0 for unthrottled replay
+    """
+    v = v.strip().lower()
+    if v == SPEED_MAX:
+        return 0
+    return max(float(v.rstrip('x')), 0)
+
+
+def parse_time(v: str) -> float:
+    """
+    Parses a wall-clock time
+    :param v: UNIX timestamp or local time, e.g. "1527454800" or "2018-05-27 23:00:00"
+    :return: UNIX timestamp
+    """
+    v = v.strip()
+    try:
+        return float(v)
+    except ValueError:
+        return datetime.strptime(v, '%Y-%m-%d %H:%M:%S').timestamp()
+
+
+class ReplayClock(object):
+    """
+    Replays time differences of a log against absolute deadlines, so sleep
+    overshoot does not accumulate. Gaps longer than max_gap are shortened
+    to gap_replacement seconds.
+    """
+
+    def __init__(self,
+                 speed: float = 1.0,
+                 max_gap: float = 30,
+                 gap_replacement: float = 0.1):
+        """
+        :param speed: Speed multiplier, 0 replays as fast as possible
+        :param max_gap: Max. time difference in [sec] replayed as is
+        :param gap_replacement: Time in [sec] replayed instead of a longer gap
+        """
+        self._speed = speed
+        self._max_gap = max_gap
+        self._gap_replacement = gap_replacement
+        self.start()
+
+    @property
+    def speed(self) -> float:
+        return self._speed
+
+    @property
+    def unthrottled(self) -> bool:
+        return self._speed <= 0
+
+    def start(self):
+        """
+        Starts a new replay run and resets the statistics
+        """
+        self._start = monotonic()
+        self._position = 0.0
+        self._messages = 0
+        self._max_lag = 0.0
+        self._total_lag = 0.0
+
+    def wait(self, time_dif: float) -> float:
+        """
+        Advances the replay position by the given time difference and
+        waits until it is reached
+        :param time_dif: Time in [sec] since the previous entry of the log
+        :return: The time difference actually replayed (shortened for long gaps)
+        """
+        if time_dif > self._max_gap:
+            time_dif = self._gap_replacement
+        self._position += max(time_dif, 0)
+        self._messages += 1
+
+        if self.unthrottled:
+            return time_dif
+
+        delay = self._start + self._position / self._speed - monotonic()
+        if delay > 0:
+            sleep(delay)
+        else:
+            self._max_lag = max(self._max_lag, -delay)
+            self._total_lag += -delay
+        return time_dif
+
+    @property
+    def position(self) -> float:
+        """
+        Replayed log time in [sec]
+        """
+        return self._position
+
+    def report(self) -> (int, float, float, float, float):
+        """
+        Returns the statistics of the current run:
+        messages, duration [sec], messages per second, max. lag [sec] and average lag [sec]
+        """
+        duration = monotonic() - self._start
+        return (self._messages,
+                duration,
+                self._messages / duration if duration > 0 else 0,
+                self._max_lag,
+                self._total_lag / self._messages if self._messages else 0)
+
+
+class ReplayLog(object):
+    """
+    Log held in memory as columns of timestamps, type codes and values,
+    ordered and indexed by timestamp so replay can start anywhere
+    """
+
+    def __init__(self):
+        self._types = []
+        self._type_codes = {}
+        self._timestamps = array('d')
+        self._codes = array('H')
+        self._values = array('d')
+        self._ordered = True
+
+    @staticmethod
+    def load(entries) -> 'ReplayLog':
+        """
+        :param entries: Iterable of tuples (type, timestamp, value) with numeric values
+        """
+        log = ReplayLog()
+        for type, timestamp, value in entries:
+            log.append(type, timestamp, value)
+        log._sort()
+        return log
+
+    def append(self, type: str, timestamp: float, value: float):
+        code = self._type_codes.get(type)
+        if code is None:
+            code = self._type_codes[type] = len(self._types)
+            self._types.append(type)
+        if self._timestamps and timestamp < self._timestamps[-1]:
+            self._ordered = False
+        self._timestamps.append(timestamp)
+        self._codes.append(code)
+        self._values.append(value)
+
+    def _sort(self):
+        if self._ordered:
+            return
+        order = sorted(range(len(self._timestamps)), key=self._timestamps.__getitem__)
+        self._timestamps = array('d', [self._timestamps[i] for i in order])
+        self._codes = array('H', [self._codes[i] for i in order])
+        self._values = array('d', [self._values[i] for i in order])
+        self._ordered = True
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    @property
+    def start(self) -> float:
+        return self._timestamps[0] if self._timestamps else 0.0
+
+    @property
+    def end(self) -> float:
+        return self._timestamps[-1] if self._timestamps else 0.0
+
+    def index(self, timestamp: float) -> int:
+        """
+        Returns the index of the first entry at or after the given timestamp
+        """
+        self._sort()
+        return bisect_left(self._timestamps, timestamp)
+
+    def range(self, start: float = None, duration: float = None) -> (int, int):
+        """
+        Returns the indices [first, last) of the entries within a time range
+        :param start: Timestamp to start at, defaults to the start of the log
+        :param duration: Length of the range in [sec], defaults to the end of the log
+        """
+        first = self.index(self.start if start is None else start)
+        if duration is None:
+            return first, len(self)
+        t = self._timestamps[first] if first < len(self) else self.end
+        return first, max(self.index(t + duration), first)
+
+    def entries(self, first: int = 0, last: int = None):
+        """
+        Returns the entries within [first, last) as tuples (type, value, time_dif),
+        the time difference of the first entry being 0
+        """
+        self._sort()
+        if last is None:
+            last = len(self)
+        types, timestamps, codes, values = self._types, self._timestamps, self._codes, self._values
+        last_t = timestamps[first] if first < last else 0.0
+        for i in range(first, last):
+            t = timestamps[i]
+            v = values[i]
+            yield types[codes[i]], int(v) if v.is_integer() else v, t - last_t
+            last_t = t
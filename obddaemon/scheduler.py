@@ -0,0 +1,83 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+"""
+from time import monotonic, sleep
+
+
+class PollScheduler(object):
+    """
+    Deadline based polling scheduler.
+    Every item gets its own target rate. Items are handed out earliest deadline
+    first, a deadline advancing by one period per poll. This shares the available
+    time proportionally to the target rates when the interface cannot keep up,
+    while items with a low rate never starve. Lateness is capped at max_backlog
+    seconds so a temporary stall does not cause a burst afterwards.
+    """
+
+    def __init__(self, rates: dict, max_backlog: float = 1.0):
+        """
+        :param rates: Target rate in [Hz] per item, items with a rate <= 0 are never polled
+        :param max_backlog: Max. time in [sec] an item is allowed to fall behind its schedule
+        """
+        now = monotonic()
+        self._periods = {k: 1 / r for k, r in rates.items() if r > 0}
+        self._deadlines = {k: now for k in self._periods}
+        self._counts = {k: 0 for k in self._periods}
+        self._max_backlog = max_backlog
+        self._report_start = now
+
+    @property
+    def items(self) -> list:
+        return list(self._periods.keys())
+
+    def due(self, now: float = None) -> list:
+        """
+        Returns all items due at the given time, most overdue first
+        """
+        if now is None:
+            now = monotonic()
+        return sorted([k for k, d in self._deadlines.items() if d <= now],
+                      key=self._deadlines.get)
+
+    def delay(self) -> float:
+        """
+        Returns the time in [sec] until the next item is due
+        """
+        if not self._deadlines:
+            return 0
+        return max(min(self._deadlines.values()) - monotonic(), 0)
+
+    def wait(self) -> list:
+        """
+        Sleeps until the next item is due and returns all due items
+        """
+        delay = self.delay()
+        if delay > 0:
+            sleep(delay)
+        return self.due()
+
+    def mark_polled(self, item, now: float = None):
+        """
+        Marks the given item as polled and schedules its next deadline
+        """
+        if item not in self._periods:
+            return
+        if now is None:
+            now = monotonic()
+        self._counts[item] += 1
+        self._deadlines[item] = max(self._deadlines[item] + self._periods[item],
+                                    now - self._max_backlog)
+
+    def report(self) -> dict:
+        """
+        Returns the achieved and target rate in [Hz] per item since the last
+        report and resets the counters
+        """
+        now = monotonic()
+        duration = max(now - self._report_start, 1e-9)
+        r = {k: (self._counts[k] / duration, 1 / p) for k, p in self._periods.items()}
+        self._counts = {k: 0 for k in self._periods}
+        self._report_start = now
+        return r
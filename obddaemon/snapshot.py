@@ -0,0 +1,202 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Memory-mapped snapshot of the latest value and time of every channel, for local
+consumers reading without going through Redis:
+
+    with SnapshotReader('/dev/shm/carpi.obd.snapshot') as snapshot:
+        rpm, t = snapshot.read('rpm')
+
+Layout (little endian):
+- header: magic "COBD", layout version (u16), slot size (u16), slot count (u32),
+  followed by the channel name of every slot (32 bytes, zero padded)
+- slots, starting at a multiple of 64: sequence (u64), value (f64), time (f64, sec since the epoch)
+
+Every slot is protected by its sequence as a seqlock: the writer makes it odd before
+and even again after changing the slot, a reader retries until it read the same even
+sequence before and after the value. Reads never block the writer.
+A writer which died while writing a slot leaves it unreadable until the next writer opens the file.
+Only depends on the standard library, to be imported by consumers quickly.
+"""
+import mmap
+import os
+import struct
+from numbers import Number
+from threading import Lock
+from time import time, sleep
+
+MAGIC = b'COBD'
+LAYOUT_VERSION = 1
+NAME_SIZE = 32
+SLOT_SIZE = 32
+# a reader spins this often on a slot being written, then yields to let the writer finish
+SPIN_ATTEMPTS = 100
+MAX_READ_ATTEMPTS = 10000
+
+_HEADER = struct.Struct('<4sHHI')
+_NAME = struct.Struct('<{}s'.format(NAME_SIZE))
+_SEQ = struct.Struct('<Q')
+_SLOT = struct.Struct('<Qdd')
+_DATA = struct.Struct('<dd')
+
+
+def _slots_offset(count: int) -> int:
+    end = _HEADER.size + NAME_SIZE * count
+    return (end + 63) // 64 * 64
+
+
+def _build_header(names: list) -> bytes:
+    header = bytearray(_slots_offset(len(names)))
+    _HEADER.pack_into(header, 0, MAGIC, LAYOUT_VERSION, SLOT_SIZE, len(names))
+    for i, name in enumerate(names):
+        _NAME.pack_into(header, _HEADER.size + NAME_SIZE * i, name.encode('utf-8'))
+    return bytes(header)
+
+
+def _parse_header(buf) -> list:
+    """
+    :return: Channel names of the slots
+    """
+    magic, version, slot_size, count = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != LAYOUT_VERSION or slot_size != SLOT_SIZE:
+        raise ValueError("Not a snapshot of layout version {}".format(LAYOUT_VERSION))
+    return [_NAME.unpack_from(buf, _HEADER.size + NAME_SIZE * i)[0].rstrip(b'\0').decode('utf-8')
+            for i in range(count)]
+
+
+class SnapshotWriter(object):
+    """
+    Writes the latest values into the snapshot file, there must be only one writer per file
+    """
+
+    def __init__(self, path: str, names: list):
+        """
+        :param path: Snapshot file, preferably on a tmpfs like /dev/shm
+        :param names: Channel name of every slot
+        """
+        self.path = path
+        self._offsets = {}
+        self._lock = Lock()
+
+        header = _build_header(names)
+        size = len(header) + SLOT_SIZE * len(names)
+        if not self._reusable(header, size):
+            # readers never see a partially written header
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(header)
+                f.write(bytes(size - len(header)))
+            os.replace(tmp, path)
+
+        with open(path, 'r+b') as f:
+            self._mm = mmap.mmap(f.fileno(), size)
+        for i, name in enumerate(names):
+            offset = self._offsets[name] = len(header) + SLOT_SIZE * i
+            # a slot left odd by a writer which died while writing it
+            seq = _SEQ.unpack_from(self._mm, offset)[0]
+            if seq & 1:
+                _SEQ.pack_into(self._mm, offset, seq + 1)
+
+    def _reusable(self, header: bytes, size: int) -> bool:
+        # an existing file of the same layout keeps the readers mapping it working across restarts
+        try:
+            with open(self.path, 'rb') as f:
+                return os.fstat(f.fileno()).st_size == size and f.read(len(header)) == header
+        except IOError:
+            return False
+
+    def write(self, name: str, value, t: float = None):
+        """
+        Sets the latest value of a channel, ignores unknown channels and non-numeric values
+        """
+        offset = self._offsets.get(name)
+        if offset is None or not isinstance(value, Number):
+            return
+        if t is None:
+            t = time()
+
+        mm = self._mm
+        with self._lock:
+            seq = _SEQ.unpack_from(mm, offset)[0]
+            _SEQ.pack_into(mm, offset, seq + 1)
+            _DATA.pack_into(mm, offset + _SEQ.size, value, t)
+            _SEQ.pack_into(mm, offset, seq + 2)
+
+    def close(self):
+        self._mm.close()
+
+
+class SnapshotReader(object):
+    """
+    Reads the latest values from a snapshot file written by a SnapshotWriter
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._inode = os.fstat(f.fileno()).st_ino
+        self.names = _parse_header(self._mm)
+        offset = _slots_offset(len(self.names))
+        self._offsets = {name: offset + SLOT_SIZE * i for i, name in enumerate(self.names)}
+
+    def read(self, name: str) -> tuple:
+        """
+        :param name: Channel name, e.g. "rpm"
+        :return: Latest value and its time (sec since the epoch), None if none has been written yet
+        """
+        offset = self._offsets[name]
+        mm = self._mm
+        for attempt in range(MAX_READ_ATTEMPTS):
+            seq, value, t = _SLOT.unpack_from(mm, offset)
+            if not seq & 1 and _SEQ.unpack_from(mm, offset)[0] == seq:
+                return (value, t) if seq else None
+            if attempt >= SPIN_ATTEMPTS:
+                # the writer may have been preempted within the slot, e.g. on a single core
+                sleep(0)
+        raise TimeoutError("Snapshot slot {} is not stable".format(name))
+
+    def read_all(self) -> dict:
+        """
+        :return: Channel name -> latest value and time, for all channels with a value
+        """
+        results = {}
+        for name in self.names:
+            v = self.read(name)
+            if v is not None:
+                results[name] = v
+        return results
+
+    @property
+    def stale(self) -> bool:
+        """
+        True if the file has been replaced by a writer with another layout, reopen the reader then
+        """
+        try:
+            return os.stat(self.path).st_ino != self._inode
+        except IOError:
+            return True
+
+    def close(self):
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Prints the latest values of a snapshot file')
+    parser.add_argument('path', nargs='?', default='/dev/shm/carpi.obd.snapshot')
+    args = parser.parse_args()
+
+    with SnapshotReader(args.path) as reader:
+        now = time()
+        for n, (v, ts) in sorted(reader.read_all().items()):
+            print("{:<20} {:>12g} {:>8.1f} sec ago".format(n, v, now - ts))
@@ -0,0 +1,226 @@
+"""
+CARPI OBD II DAEMON
+(C) 2018, Raphael "rGunti" Guntersweiler
+Licensed under MIT
+
+Runs one daemon process per adapter configured in [Adapter.<name>] sections:
+python -m obddaemon --supervisor [--serial]
+"""
+import multiprocessing
+import sys
+from configparser import ConfigParser
+from os import environ, kill
+from signal import SIGINT
+from time import sleep, monotonic
+
+from carpicommons.errors import CarPiExitException
+from carpicommons.log import logger, log_unhandled_exception
+from daemoncommons.daemon import Daemon
+
+from obddaemon.custom.errors import SerialObdError, SerialObdConfigurationError
+from obddaemon.errors import ObdConnectionError
+from obddaemon.keys import ENV_KEY_BASE
+from obddaemon.registry import load_daemon, MODE_OBD
+
+ADAPTER_SECTION_PREFIX = 'Adapter.'
+
+# exit codes of a worker process, the daemons' exit codes (0xFXXX) do not fit into a process exit code
+EXIT_OK = 0
+EXIT_FAILURE = 1        # unhandled exception
+EXIT_CONNECTION = 2     # ObdConnectionError or SerialObdError
+EXIT_CONFIGURATION = 3  # invalid configuration, the worker is not restarted
+
+EXIT_REASONS = {
+    EXIT_OK: 'stopped',
+    EXIT_FAILURE: 'failed',
+    EXIT_CONNECTION: 'lost its connection',
+    EXIT_CONFIGURATION: 'is misconfigured'
+}
+
+
+def build_worker_config(config: ConfigParser, section: str) -> dict:
+    """
+    Builds the configuration of an adapter worker: options of the adapter section override [OBD],
+    options named "<Section>.<Key>" override the given key in another section
+    :param config: Supervisor configuration
+    :param section: Adapter section, e.g. "Adapter.bench1"
+    :return: Configuration as dictionary, see ConfigParser.read_dict
+    """
+    d = {s: dict(config.items(s, raw=True)) for s in config.sections()
+         if not s.startswith(ADAPTER_SECTION_PREFIX)}
+    for key, value in config.items(section, raw=True):
+        if key == 'keybase':
+            continue
+        target, option = key.split('.', 1) if '.' in key else ('OBD', key)
+        # ConfigParser lower cases options but keeps the section's case
+        target = next((s for s in d if s.lower() == target.lower()), target)
+        d.setdefault(target, {})[option] = value
+    return d
+
+
+def run_worker(name: str, mode: str, config: dict, counter):
+    """
+    Entry point of a worker process, runs the daemon of one adapter
+    :param name: Adapter name
+    :param mode: Daemon to run (see obddaemon.registry)
+    :param config: Worker configuration (see build_worker_config)
+    :param counter: Shared counter of the published values
+    """
+    parser = ConfigParser()
+    parser.read_dict(config)
+    daemon = load_daemon(mode)()
+    daemon.set_publish_counter(counter)
+
+    exit_code = EXIT_OK
+    try:
+        daemon.set_config(parser)
+        daemon.startup()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except SerialObdConfigurationError:
+        exit_code = EXIT_CONFIGURATION
+    except (ObdConnectionError, SerialObdError):
+        exit_code = EXIT_CONNECTION
+    except CarPiExitException as e:
+        exit_code = EXIT_OK if not e.exit_code else EXIT_FAILURE
+    except:
+        exit_code = EXIT_FAILURE
+        log_unhandled_exception()
+    finally:
+        daemon.shutdown()
+    sys.exit(exit_code)
+
+
+class _Worker(object):
+    def __init__(self, name: str, key_base: str, config: dict, counter):
+        self.name = name
+        self.key_base = key_base
+        self.config = config
+        self.counter = counter
+        self.process: multiprocessing.Process = None
+        self.started = 0.0
+        self.restart_at = 0.0
+        self.restart_delay = 0.0
+        self.restarts = 0
+        self.last_count = 0
+
+
+class Supervisor(Daemon):
+    """
+    Starts a daemon process per configured adapter, restarts failed ones
+    with an exponential backoff and reports the aggregate throughput
+    """
+
+    def __init__(self, mode: str = MODE_OBD):
+        """
+        :param mode: Daemon run per adapter (see obddaemon.registry)
+        """
+        super().__init__("OBD Supervisor")
+        self._mode = mode
+        self._log = None
+        self._workers = []
+        self._running = False
+        # spawned processes import everything anew, with the key base of their adapter
+        self._context = multiprocessing.get_context('spawn')
+
+    def startup(self):
+        self._log = log = logger(self.name)
+        log.info("Starting up %s ...", self.name)
+
+        adapters = [s for s in self._config.sections() if s.startswith(ADAPTER_SECTION_PREFIX)]
+        if not adapters:
+            log.error("No adapters configured, add [%s<name>] sections", ADAPTER_SECTION_PREFIX)
+            return
+
+        for section in adapters:
+            name = section[len(ADAPTER_SECTION_PREFIX):]
+            key_base = self._get_config(section, 'KeyBase', 'carpi.obd.{}.'.format(name))
+            self._workers.append(_Worker(name, key_base,
+                                         build_worker_config(self._config, section),
+                                         self._context.Value('Q', 0, lock=False)))
+
+        min_delay = self._get_config_float('Supervisor', 'RestartDelay', 1)
+        max_delay = self._get_config_float('Supervisor', 'MaxRestartDelay', 60)
+        stable_time = self._get_config_float('Supervisor', 'StableTime', 60)
+        interval = self._get_config_float('Supervisor', 'ReportInterval', 10)
+
+        for w in self._workers:
+            w.restart_delay = min_delay
+            self._start(w)
+
+        self._running = True
+        last_report = monotonic()
+        while self._running:
+            sleep(0.5)
+            now = monotonic()
+            for w in self._workers:
+                if w.process is None:
+                    if w.restart_at and now >= w.restart_at:
+                        w.restarts += 1
+                        self._start(w)
+                    continue
+                if w.process.is_alive():
+                    continue
+
+                exit_code = w.process.exitcode
+                w.process = None
+                log.warning("Worker %s %s (exit code %s)", w.name,
+                            EXIT_REASONS.get(exit_code, 'crashed'), exit_code)
+                if exit_code == EXIT_CONFIGURATION:
+                    w.restart_at = 0
+                    continue
+
+                # a worker running for a while starts over with the shortest delay
+                if now - w.started >= stable_time:
+                    w.restart_delay = min_delay
+                w.restart_at = now + w.restart_delay
+                log.info("Restarting worker %s in %.0f seconds", w.name, w.restart_delay)
+                w.restart_delay = min(w.restart_delay * 2, max_delay)
+
+            if interval > 0 and now - last_report >= interval:
+                self._report_throughput(now - last_report)
+                last_report = now
+
+    def _start(self, w: _Worker):
+        self._log.info("Starting worker %s (keys %s*)", w.name, w.key_base)
+        w.process = self._context.Process(target=run_worker,
+                                          args=(w.name, self._mode, w.config, w.counter),
+                                          name='OBD Worker {}'.format(w.name),
+                                          daemon=True)
+        # the spawned process inherits the environment at the time it is started
+        previous = environ.get(ENV_KEY_BASE)
+        environ[ENV_KEY_BASE] = w.key_base
+        try:
+            w.process.start()
+        finally:
+            if previous is None:
+                del environ[ENV_KEY_BASE]
+            else:
+                environ[ENV_KEY_BASE] = previous
+        w.started = monotonic()
+        w.restart_at = 0
+
+    def _report_throughput(self, elapsed: float):
+        total = 0
+        for w in self._workers:
+            count = w.counter.value
+            rate = (count - w.last_count) / elapsed
+            w.last_count = count
+            total += rate
+            self._log.info("Throughput %-12s %8.1f values/sec (%s, %d restarts)", w.name, rate,
+                           'running' if w.process else 'down', w.restarts)
+        self._log.info("Throughput %-12s %8.1f values/sec", 'total', total)
+
+    def shutdown(self):
+        self._running = False
+        # interrupted workers shut their daemon down properly
+        for w in self._workers:
+            if w.process and w.process.is_alive():
+                kill(w.process.pid, SIGINT)
+        for w in self._workers:
+            if w.process:
+                w.process.join(5)
+                if w.process.is_alive():
+                    w.process.terminate()
+        if self._log:
+            self._log.info("%s stopped", self.name)
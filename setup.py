@@ -31,5 +31,8 @@ setup(name='carpi-obddaemon',
           'obd',
           'wheel'
       ],
+      extras_require={
+          'batch': ['numpy']
+      },
       zip_safe=False,
       include_package_data=True)